@@ -1 +1,2 @@
-__all__ = ['data', 'drift_correct', 'gantry_correct', 'scan']
\ No newline at end of file
+__all__ = ['adaptive', 'data', 'drift_correct', 'gantry_correct', 'grid',
+           'path', 'pipeline', 'scan', 'scanfile', 'scanlog', 'sweep']
\ No newline at end of file
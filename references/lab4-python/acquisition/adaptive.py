@@ -0,0 +1,179 @@
+"""Adaptive scans, measuring more points where the surface is not flat.
+
+An AdaptiveScan first measures a coarse raster.  It then splits every
+cell of the raster (the rectangle between four neighboring points) that
+its neighborhood does not fit to a plane into four, measures the new
+corners, and repeats with the new cells, up to a maximum depth or number
+of points.  Flat areas keep the coarse spacing, while edges, steps and the
+borders of dark regions are refined.
+
+Every pass is a scan.Scan of the points it adds, so drift and gantry
+correction, path planning and pipelines work as for any other scan.
+
+Classes:
+AdaptiveScan -- A raster scan refined pass by pass.
+
+Functions:
+lattice -- Return the coordinates of a refined lattice of points.
+"""
+
+from lsst.acquisition import data, drift_correct, gantry_correct, scan
+from lsst.analysis import utils
+import numpy, time
+
+def lattice(values, index, depth):
+    """Return the coordinates at 'index' of 'values' halved 'depth' times.
+
+    Index n * 2**depth is values[n], and the indices in between divide the
+    interval to values[n+1] evenly.
+    """
+    index = numpy.asarray(index)
+    n, part = index // 2**depth, index % 2**depth
+    following = values[numpy.minimum(n + 1, len(values) - 1)]
+    return values[n] + (following - values[n]) * part / 2.**depth
+
+class AdaptiveScan:
+    """A raster scan that refines the cells it cannot fit to a plane.
+
+    Points are addressed by (i, j) on the lattice of the coarse raster
+    halved 'depth' times, and cells by (i, j, size) with their first corner
+    and their side in lattice steps.
+
+    Instance variables:
+    data -- The coarse raster before run(), and every point measured after
+        it, as one dimensional data with a "level" column: the pass that
+        measured the point, 0 for the coarse raster.
+    passes -- The number of points measured by each pass.
+    """
+
+    def __init__(self, x, y, residual=1., gradient=None, depth=3,
+                 budget=None, drift=drift_correct.DriftCorrector(),
+                 gantry=gantry_correct.GantryCorrector(), schedule=None,
+                 telemetry=None, readback=False):
+        """Create an adaptive scan starting from the raster of 'x' and 'y'.
+
+        Parameters:
+        x, y -- The 1-d coordinates of the coarse raster, in mm.
+        residual -- The largest deviation (um) from the best-fit plane of
+            the 4x4 points around a cell before the cell is split.
+        gradient -- The largest slope (um/mm) along the edges of a cell
+            before it is split, or None for no limit.
+        depth -- The most times a coarse cell may be halved.
+        budget -- The most points to measure in all, or None for no limit.
+
+        Cells with both dark and lit corners are always split.  The other
+        parameters are as for scan.Scan; 'schedule' is shared by all the
+        passes, and is by default an AdaptiveSchedule keeping the drift
+        error below half of 'residual' if the drift corrector has points.
+        """
+        self.x = numpy.asarray(x, dtype='float')
+        self.y = numpy.asarray(y, dtype='float')
+        self.residual, self.gradient = residual, gradient
+        self.depth, self.budget = depth, budget
+        self.drift, self.gantry = drift, gantry
+        if schedule is None and len(drift.xy):
+            schedule = drift_correct.AdaptiveSchedule(residual / 2.,
+                                                      drift.reps)
+        self.schedule, self.telemetry = schedule, telemetry
+        self.readback = readback
+        self.data = data.raster_data(self.x, self.y)
+        self.known, self.passes = {}, []
+
+    def measure(self, d, level, pipeline=None):
+        """Scan the points of 'd' and add them to self.data."""
+        scan.Scan(d, self.drift, self.gantry, schedule=self.schedule,
+                  telemetry=self.telemetry,
+                  readback=self.readback).run(pipeline)
+        d = d.flat()
+        d.data["level"] = numpy.zeros(len(d), dtype='int32') + level
+        self.data = d if level == 0 else self.data + d
+        self.passes.append(len(d))
+
+    def point(self, i, j):
+        """Return the flat index in self.data of lattice point (i, j)."""
+        return self.known.get((i, j))
+
+    def score(self, cell):
+        """Return how far a cell is beyond the thresholds (> 1 to split)."""
+        i, j, size = cell
+        corners = [self.point(i + a, j + b) for b in (0, size)
+                   for a in (0, size)]
+        z = self.data.z[corners]
+        lit = numpy.isfinite(z)
+        if not lit.any(): return 0.
+        if not lit.all(): return numpy.inf
+        stencil = [self.point(i + a*size, j + b*size) for b in range(-1, 3)
+                   for a in range(-1, 3)]
+        stencil = numpy.array([n for n in stencil if n is not None])
+        stencil = stencil[numpy.isfinite(self.data.z[stencil])]
+        xy, zs = self.data.points[stencil], self.data.z[stencil]
+        score = (numpy.max(abs(zs - utils.evalplane(utils.fitplane(xy, zs),
+                                                    xy))) / self.residual
+                 if len(stencil) > 3 else 0.)
+        if self.gradient is not None:
+            xy = self.data.points[corners]
+            for m, n in [(0, 1), (2, 3), (0, 2), (1, 3)]:
+                slope = abs(z[m] - z[n]) / numpy.hypot(*(xy[m] - xy[n]))
+                score = max(score, slope / self.gradient)
+        return score
+
+    def refine(self, cells):
+        """Return the cells to split and the lattice points they add.
+
+        Cells are taken from the highest score down, while the budget
+        allows.
+        """
+        scores = [self.score(cell) for cell in cells]
+        count, split, new = len(self.data), [], []
+        added = set()
+        for n in numpy.argsort(scores)[::-1]:
+            i, j, size = cells[n]
+            if scores[n] <= 1 or size < 2: continue
+            h = size // 2
+            pts = [pt for pt in [(i + h, j), (i, j + h), (i + h, j + h),
+                                 (i + size, j + h), (i + h, j + size)]
+                   if pt not in self.known and pt not in added]
+            if self.budget is not None and count + len(pts) > self.budget:
+                break
+            split.append(cells[n])
+            new.extend(pts)
+            added.update(pts)
+            count += len(pts)
+        return split, new
+
+    def run(self, pipeline=None):
+        """Measure the coarse raster, then refine it pass by pass.
+
+        The pipeline, if given, is used by every pass (see Scan.run).
+        """
+        step = 2**self.depth
+        ny, nx = self.data.shape
+        self.known = dict(((i*step, j*step), j*nx + i) for j in range(ny)
+                          for i in range(nx))
+        self.passes = []
+        self.measure(self.data, 0, pipeline)
+        cells = [(i*step, j*step, step) for j in range(ny - 1)
+                 for i in range(nx - 1)]
+        for level in range(1, self.depth + 1):
+            split, new = self.refine(cells)
+            if not split: break
+            if new:
+                ij = numpy.array(new, dtype='int')
+                for n, pt in enumerate(new):
+                    self.known[pt] = len(self.data) + n
+                self.measure(data.Data(numpy.column_stack(
+                    [lattice(self.x, ij[:,0], self.depth),
+                     lattice(self.y, ij[:,1], self.depth)])), level, pipeline)
+            cells = [(i + a, j + b, size // 2) for i, j, size in split
+                     for b in (0, size // 2) for a in (0, size // 2)]
+
+    def save(self, path):
+        """Save the scanned data to a binary scan file."""
+        self.data.save(path, dict(self.data.meta, points=len(self.data),
+            passes=self.passes, saved=time.strftime('%Y-%m-%d %H:%M:%S')))
+
+    def write(self, out):
+        out.write(time.strftime('# Adaptive scan of {0} points'
+                                .format(len(self.data)) +
+                                ' from %Y-%m-%d at %H:%M:%S\n'))
+        self.data.write(out)
@@ -1,3 +1,4 @@
+from lsst.acquisition import grid
 import numpy
 
 def emptynan(shape):
@@ -6,6 +7,9 @@ def emptynan(shape):
     return temp
 
 def from_file(path):
+    """Read data saved with either Data.save or Data.write."""
+    from lsst.acquisition import scanfile
+    if scanfile.is_scanfile(path): return scanfile.read(path)
     arr = numpy.loadtxt(path)
     return Data(arr[:,1:3], z= arr[:,3], t=arr[:,0])
 
@@ -14,93 +18,265 @@ def gantry_file(path):
     return Data(arr[:,0:2], z= arr[:,2])
 
 def raster_data(x, y, **kwargs):
-    assert len(x.shape) == 1
-    assert len(y.shape) == 1
-    return Data(numpy.dstack(numpy.meshgrid(x, y)), **kwargs)
+    """Return the Data of a raster, built lazily (see grid.Raster)."""
+    return Data(grid.Raster(x, y), **kwargs)
 
 def tiled_data(tile_orig, points, **kwargs):
-    assert len(tile_orig.shape) == 2
-    assert tile_orig.shape[1] == 2
-    assert points.shape[-1] == 2
-    return Data(tile_orig + points[...,None,:],
-                tiles=numpy.tile(numpy.arange(tile_orig.shape[0]),
-                                 points.shape[:-1]+(1,)))
+    """Return the Data of tiles, built lazily (see grid.Tiled).
+
+    Parameter 'points' is an array of shape (..., 2) or a grid.Grid, such
+    as a grid.Raster, holding the points of one tile.
+    """
+    return Data(grid.Tiled(tile_orig, points), **kwargs)
+
+class Data(object):
+    """Scan points and their columns, kept as plain numpy arrays.
+
+    Attribute 'points' has shape (..., 2) and 'data' maps each column name
+    ("tiles", "z", "t" and any extras) to an array of shape (...).  Slicing
+    returns a Data sharing these arrays wherever numpy can give a view, and
+    taking a tile a read-only Data (see tile()).
+
+    Data created from a grid.Grid keeps it in 'grid' and only builds its
+    arrays when 'points' or 'data' is first used; until then point() and
+    lookup() answer from the grid alone.
+    """
+    __slots__ = ('_points', '_data', 'grid', 'smartiter', 'indices', 'path',
+                 'meta', 'tileindex', 'tilekeys')
 
-class Data:
     def __init__(self, points=numpy.empty((0,2)), tiles=None, z=None,
-                 t=None, smartiter=True):
+                 t=None, smartiter=True, **columns):
         """Create the necessary empty arrays to hold data.
         
-        Parameter 'points' is an array with shape (..., 2).
+        Parameter 'points' is an array with shape (..., 2), or a grid.Grid.
         Parameter 'tiles' is an array with shape (...).
+        Any other keyword argument is an extra column, such as a
+        temperature, with shape (...).  If 'points' is a grid and no column
+        is given, no array is built yet.
         """
-        self.data = {}
-        self.points = numpy.array(points)
-        self.data["tiles"] = (numpy.zeros(self.shape, dtype='int') if tiles
-                              is None else numpy.array(tiles, dtype='int'))
+        self.smartiter = smartiter
+        self.indices = {}
+        self.path = None
+        self.meta = {}
+        self.tileindex = self.tilekeys = None
+        self.grid = self._points = self._data = None
+        if isinstance(points, grid.Grid):
+            self.grid = points
+            if all(col is None for col in (tiles, z, t)) and not columns:
+                return
+            tiles = points.tiles() if tiles is None else tiles
+            points = points.points()
+        self._points, self._data = numpy.array(points), {}
+        self.data["tiles"] = (numpy.zeros(self.shape, dtype='int32') if tiles
+                              is None else numpy.array(tiles, dtype='int32'))
         self.data["z"] = emptynan(self.shape) if z is None else numpy.array(z)
         self.data["t"] = emptynan(self.shape) if t is None else numpy.array(t)
-        self.smartiter = smartiter
+        for name in columns: self.data[name] = numpy.array(columns[name])
         
         #Make sure everything looks reasonable
         assert self.points.shape[-1] == 2
         for obj in self.data:
             assert self.data[obj].shape == self.shape
     
+    #The arrays, built from the grid on first use
+    @property
+    def points(self):
+        if self._points is None: self._points = self.grid.points()
+        return self._points
+    @points.setter
+    def points(self, value):
+        #The columns have to be built while the grid is still there
+        if getattr(self, 'grid', None) is not None: self.data
+        self._points, self.grid = value, None
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = {"tiles": self.grid.tiles(),
+                          "z": emptynan(self.shape), "t": emptynan(self.shape)}
+        return self._data
+    @data.setter
+    def data(self, value): self._data = value
+    
+    #Shortcuts to the shape, time and z
+    @property
+    def shape(self):
+        return (self.grid.shape if self._points is None
+                else self._points.shape[:-1])
+    @property
+    def z(self): return self.data["z"]
+    @z.setter
+    def z(self, value): self.data["z"] = value
+    @property
+    def t(self): return self.data["t"]
+    @t.setter
+    def t(self, value): self.data["t"] = value
+    
     #Pythonic methods
-    def __getattr__(self, name): # shortcuts to access time and z
-        if name == "shape": return self.points.shape[:-1]
-        elif name in ['z', 't']: return self.data[name]
-        else: raise AttributeError, name
-    def __setattr__(self, name, value):
-        if name in ['z', 't']: self.data[name] = value
-        else: self.__dict__[name] = value
     def __len__(self): return int(numpy.prod(self.shape))
+    def point(self, index):
+        """Return the (x, y) of the point at 'index'."""
+        if self._points is None: return self.grid.point(index)
+        return self._points[index]
+    def lookup(self, pt):
+        """Return the index of the point at 'pt', or None if there is none.
+
+        Points match to within grid.resolution.  Without a grid, the first
+        lookup builds a grid.PointList over the points.
+        """
+        if self.grid is None: self.grid = grid.PointList(self.points)
+        return self.grid.index(pt)
     def __iter__(self):
         """Iterate over points in an approximately optimal order.
         
-        Algorithm: at each iteration, go to the closest point remaining.
+        The order is planned once by plan() (see path.py), or is simply the
+        storage order if self.smartiter is false.
         """
-        curpt, done = [0,0], numpy.zeros(self.shape, dtype='bool')
-        while not done.all():
-            #The following line computes the nearest remaining point...
-            closest = numpy.unravel_index((numpy.where(done, numpy.inf,
-                (numpy.sum((self.points - curpt)**2, axis=-1))) if
-                self.smartiter else done).argmin(), self.shape)
-            #...but only if self.smartiter is true.
-            done[closest] = True
-            curpt = self.points[closest]
-            yield closest
+        order = (self.plan().order if self.smartiter
+                 else numpy.arange(len(self)))
+        return iter(zip(*numpy.unravel_index(order, self.shape)))
     def __getitem__(self, key):
-        import copy
-        dnew = copy.copy(self)
-        dnew.data = copy.copy(dnew.data)
-        dnew.decimate(key)
-        return dnew
+        return self.derive(self.points[key], dict((obj, self.data[obj][key])
+                                                  for obj in self.data))
     def __add__(self, other):
-        dnew = Data()
-        dnew.points = numpy.vstack([self.points.reshape((-1,2)),
-                                    other.points.reshape((-1,2))])
-        for obj in self.data:
-            if obj in other.data:
-                dnew.data[obj] = numpy.hstack([self.data[obj].ravel(),
-                                               other.data[obj].ravel()])
-        return dnew
+        names = [obj for obj in self.data if obj in other.data]
+        return self.derive(
+            numpy.concatenate([self.points.reshape((-1,2)),
+                               other.points.reshape((-1,2))]),
+            dict((obj, numpy.concatenate([self.data[obj].reshape(-1),
+                                          other.data[obj].reshape(-1)]))
+                 for obj in names))
     
     #Data structuring
+    def derive(self, points, data):
+        """Return a Data holding the given arrays as they are.
+        
+        Nothing is copied or checked; smartiter and meta are taken from
+        this object.
+        """
+        dnew = Data.__new__(Data)
+        dnew.points, dnew.data = points, data
+        dnew.smartiter, dnew.meta = self.smartiter, self.meta
+        dnew.indices, dnew.path = {}, None
+        dnew.tileindex = dnew.tilekeys = None
+        return dnew
     def decimate(self, valid):
-        """Remove all indices not in 'valid' from this object."""
+        """Remove all indices not in 'valid' from this object.
+        
+        If 'valid' is a boolean mask of the whole data, the tile index is
+        carried over instead of being computed again.
+        """
+        mask = (getattr(valid, 'dtype', None) == bool and
+                numpy.shape(valid) == self.shape)
+        tileindex = (self.keep_tiles(numpy.ravel(valid)) if mask and
+                     self.tileindex is not None else None)
         self.points = self.points[valid]
         for obj in self.data: self.data[obj] = self.data[obj][valid]
+        self.indices, self.path = {}, None
+        self.tileindex, self.tilekeys = tileindex, None
     def copy(self):
-        import copy
-        dnew = copy.copy(self)
-        dnew.data = copy.deepcopy(dnew.data)
+        dnew = self.derive(self.points.copy(),
+                           dict((obj, self.data[obj].copy())
+                                for obj in self.data))
+        dnew.indices, dnew.path = self.indices, self.path
         return dnew
-    def tile(self, tile):
-        return self[self.data["tiles"] == tile]
-    def tiles(self):
-        return [self.tile(tile) for tile in numpy.unique(self.data["tiles"])]
+    def flat(self):
+        """Return this data as one dimensional, as views where possible."""
+        return self.derive(self.points.reshape((-1,2)),
+                           dict((obj, self.data[obj].reshape(-1))
+                                for obj in self.data))
+    def tile_index(self):
+        """Return the tile index of this data as (numbers, order, offsets).
+        
+        'order' is a stable argsort of the flat tile column: the points of
+        tile numbers[i] are at flat positions order[offsets[i]:offsets[i+1]],
+        in increasing order.  It is computed once, and kept up to date by
+        decimate().
+        """
+        if self.tileindex is None:
+            tiles = self.data["tiles"].reshape(-1)
+            order = numpy.argsort(tiles, kind='mergesort')
+            offsets = numpy.append(numpy.flatnonzero(numpy.diff(
+                tiles[order])) + 1, len(order))
+            offsets = numpy.append(0, offsets) if len(order) else offsets
+            self.tileindex = (tiles[order[offsets[:-1]]], order, offsets)
+        return self.tileindex
+    def keep_tiles(self, valid):
+        """Return the tile index left after keeping the flat mask 'valid'."""
+        numbers, order, offsets = self.tileindex
+        keep = valid[order]
+        offsets = numpy.append(0, numpy.cumsum(keep))[offsets]
+        used = numpy.diff(offsets) > 0
+        return (numbers[used], (numpy.cumsum(valid) - 1)[order[keep]],
+                numpy.append(offsets[:1], offsets[1:][used]))
+    def tile_members(self, tile):
+        """Return the flat positions of the points of one tile."""
+        numbers, order, offsets = self.tile_index()
+        n = numpy.searchsorted(numbers, tile)
+        if n == len(numbers) or numbers[n] != tile:
+            return numpy.zeros(0, dtype='int')
+        return order[offsets[n]:offsets[n+1]]
+    def tile_keys(self):
+        """Return the flat index of the points of each tile, by tile number.
+        
+        Evenly spaced points, as in tiled_data or a single tile, are indexed
+        by a slice, so that tile() can return views instead of copies.
+        """
+        if self.tilekeys is None:
+            self.tilekeys = {}
+            for tnum in self.tile_index()[0]:
+                group = self.tile_members(tnum)
+                step = group[1] - group[0] if len(group) > 1 else 1
+                even = (numpy.diff(group) == step).all()
+                self.tilekeys[int(tnum)] = (slice(group[0], group[-1] + 1,
+                                                  step) if even else group)
+        return self.tilekeys
+    def tile(self, tile, copy=False):
+        """Return the points of one tile, flattened.
+        
+        The arrays of the tile are read-only: views of this data's arrays
+        where the tile's points are evenly spaced, and copies otherwise.
+        Either way, writing to them raises an error instead of changing
+        this data only sometimes.  With 'copy', the tile has writable
+        arrays of its own, and changing it never changes this data.
+        """
+        key = self.tile_keys().get(tile, numpy.zeros(0, dtype='int'))
+        result = self.flat()[key]
+        if copy: return result.copy()
+        result.points.setflags(write=False)
+        for obj in result.data: result.data[obj].setflags(write=False)
+        return result
+    def tiles(self, copy=False):
+        """Return every tile by increasing tile number; see tile()."""
+        return [self.tile(tile, copy) for tile in sorted(self.tile_keys())]
+    def neighbors(self, tile=None):
+        """Return a nearest-neighbor index over this data or one tile.
+
+        The index is built on first use and kept until the data changes.
+        """
+        from lsst.analysis import neighbors
+        if tile not in self.indices:
+            self.indices[tile] = neighbors.NeighborIndex(self.points,
+                None if tile is None else self.tile_members(tile))
+        return self.indices[tile]
+    def plan(self):
+        """Return the planned visit order of this data as a path.Path."""
+        from lsst.acquisition import path
+        if self.path is None: self.path = path.plan(self)
+        return self.path
+    
+    def join(self, telemetry, names=None, dtype='float32'):
+        """Add telemetry readings at the time of every point as columns.
+        
+        Parameter 'telemetry' is a telemetry.Telemetry, or anything else
+        with its 'names' and at() interface.  The readings of all channels
+        (or of those in 'names') are interpolated at self.t in one call and
+        stored as columns of the given dtype.
+        """
+        names = telemetry.names if names is None else names
+        readings = telemetry.at(self.t)
+        for name in names:
+            self.data[name] = readings[...,telemetry.names.index(name)] \
+                .astype(dtype)
     
     #Data manipulation
     def remove_dark(self):
@@ -110,20 +286,67 @@ class Data:
         """Return the best-fit plane to this data."""
         from lsst.analysis import utils
         return utils.fitplane(self.points, self.z)
+    def planes(self, workers=1):
+        """Return the best-fit plane of each tile, by tile number.
+        
+        With more than one worker the tiles are fitted in parallel (see
+        analysis/parallel.py); None means one worker per core.
+        """
+        if workers != 1:
+            from lsst.analysis import parallel
+            return parallel.planes(self, workers)
+        return dict((tnum, self.tile(tnum).plane())
+                    for tnum in self.tile_keys())
     def planarize(self):
         """Subtract the best-fit plane from this data."""
         from lsst.analysis import utils
         assert numpy.isfinite(self.z).all()
         self.z -= utils.evalplane(self.plane(), self.points)
-    def spline(self, smoothing=None):
-        """Return the best-fit spline to this data."""
+    def spline(self, smoothing=None, method='auto', **kwargs):
+        """Return the best-fit spline to this data (see surface.fit).
+        
+        By default a complete raster is fitted on its grid, up to 2000
+        other points by bisplrep, and more points by a surface.Tiled,
+        which takes no smoothing: with a 'smoothing', bisplrep is used at
+        any size, as it always was.
+        """
         from lsst.analysis import utils
-        return utils.fitspline(self.points, self.z, smoothing)
-    def remove_outliers(self, std_tol=1.5):
-        """Remove the most extreme points"""
+        return utils.fitspline(self.points, self.z, smoothing, method,
+                               **kwargs)
+    def remove_thermal(self, names=("temperature",)):
+        """Subtract the part of z that is correlated with some columns.
+        
+        z is regressed on the named columns together with x, y and a
+        constant, so that a tilt of the surface is not mistaken for a
+        temperature effect; only the fitted thermal terms are subtracted,
+        relative to their mean.  Returns the fitted coefficients of the
+        named columns, in um per unit.  Points missing a reading are left
+        as they are.
+        """
+        from lsst.analysis import utils
+        x = numpy.column_stack([self.data[name].ravel() for name in names])
+        coef = utils.fitlinear(numpy.column_stack([x,
+                               self.points.reshape((-1, 2))]), self.z.ravel())
+        good = numpy.isfinite(x).all(axis=1)
+        x = numpy.where(good[:,None], x - numpy.average(x[good], axis=0), 0)
+        self.z -= x.dot(coef[:len(names)]).reshape(self.shape)
+        return coef[:len(names)]
+    def remove_outliers(self, std_tol=1.5, workers=1):
+        """Remove the most extreme points.
+        
+        Each point is compared with its neighbors in its own tile, and all
+        tiles are decimated at once.  With more than one worker the tiles
+        are processed in parallel, as in planes().
+        """
         from lsst.analysis import outlier
-        for tnum in numpy.unique(self.data["tiles"]):
-            self.decimate(outlier.valid(self, self.data["tiles"]==tnum, std_tol=std_tol))
+        if workers != 1:
+            from lsst.analysis import parallel
+            return parallel.remove_outliers(self, std_tol, workers)
+        dev = numpy.zeros(len(self))
+        for tnum in self.tile_index()[0]:
+            index = self.neighbors(tnum)
+            dev[index.members] = outlier.deviations(self, index)
+        self.decimate((dev < std_tol * numpy.std(self.z)).reshape(self.shape))
     
     #Data visualization
     def raw_plot(*args, **kwargs): #self intentionally omitted from args
@@ -145,8 +368,12 @@ class Data:
         return ('{0:13.2f} {1[0]:06.2f} {1[1]:06.2f} {2:+06.2f} {3:02d}\n'
                 .format(self.t[i], self.points[i], self.z[i],
                         self.data["tiles"][i]))
+    def save(self, path, meta=None):
+        """Save this data to a binary scan file (see scanfile.py)."""
+        from lsst.acquisition import scanfile
+        scanfile.write(self, path, self.meta if meta is None else meta)
     def write(self, out):
-        """Write this data to a file."""
+        """Write this data to a text file."""
         out.write('# {0:<11} {1:<6} {2:<6} {3:<6} {4}\n'
                   .format('Time(s)', 'X(mm)', 'Y(mm)', 'Z(um)', 'Tile'))
         for i in self: out.write(self.format_pt(i))
@@ -1,6 +1,5 @@
 import numpy
 from scipy.interpolate import splrep, splev
-from lsst.analysis import utils
 
 class DriftCorrector:
     def __init__(self, xy=numpy.empty((0,2)), reps=0):
@@ -10,36 +9,188 @@ class DriftCorrector:
         self.z = numpy.empty((self.reps, len(self.xy)))
         self.count = 0
         self.splines = None
+        #The least-squares plane through the drift points is linear in
+        #their z-values, so every cycle's plane is one product with this.
+        self.solver = numpy.linalg.pinv(numpy.column_stack(
+                [numpy.reshape(xy, (-1, 2)), numpy.ones(len(self.xy))]))
     
     def cycle(self, func):
         """Measure one complete cycle of the drift correction points.
         
         'func' is a function that accepts a parameter 'pt' and returns
-        the time and z-value as measured at 'pt'."""
+        the time and z-value as measured at 'pt'.  The correction is
+        updated as soon as the cycle is complete.  Cycles beyond 'reps'
+        are allowed, for schedules that need them."""
+        self.grow(self.count + 1)
         for index, point in enumerate(self.xy):
             self.t[self.count, index], self.z[self.count, index] = func(point)
         self.count += 1
-        if self.count == self.reps:
-            self.count == 0
-            self.calc()
+        self.calc(self.count)
     
-    def calc(self):
+    def grow(self, count):
+        """Make room for at least 'count' cycles."""
+        extra = numpy.empty((max(count - len(self.t), 0), len(self.xy)))
+        if len(extra):
+            self.t, self.z = numpy.vstack([self.t, extra]), \
+                numpy.vstack([self.z, extra])
+    
+    def planes(self, count=None):
+        """Return the best-fit plane of each of the first 'count' cycles."""
+        count = self.count if count is None else count
+        return self.solver.dot(self.z[:count].T).T
+    
+    def calc(self, count=None):
         """Calculate the position-over-time splines.
 
-        This function is called internally after all data has been
-        acquired.  It is never called if reps=0."""
-        planes = numpy.empty((self.reps, 3))
-        for i in xrange(self.reps):
-            planes[i] = utils.fitplane(self.xy, self.z[i])
-        avgtimes = numpy.average(self.t, axis=1)
-        self.splines = [splrep(avgtimes, planes[:,n]) for n in range(3)]
+        Only the first 'count' cycles are used (all completed cycles by
+        default), so this can be called after every cycle.  The degree of
+        the splines is lowered while there are fewer than four cycles, and
+        there is no correction until there are two."""
+        count = self.count if count is None else count
+        if count < 2: return
+        planes = self.planes(count)
+        avgtimes = numpy.average(self.t[:count], axis=1)
+        self.splines = [splrep(avgtimes, planes[:,n], k=min(3, count-1))
+                        for n in range(3)]
+    
+    def errors(self, t, xy):
+        """Return the error due to drift at times 't' and points 'xy'.
+        
+        Parameter 't' is an array of any shape, and 'xy' has that shape
+        with a final dimension of 2 added."""
+        t = numpy.asarray(t, dtype='float')
+        if not self.splines: return numpy.zeros(t.shape)
+        xy = numpy.asarray(xy, dtype='float')
+        a, b, c = [splev(t.ravel(), spl).reshape(t.shape)
+                   for spl in self.splines]
+        return a*xy[...,0] + b*xy[...,1] + c
     
     def error(self, t, pt):
         """Return the error due to drift at time 't' and point 'pt'."""
-        return (utils.evalplane([splev(t, spl) for spl in self.splines], pt)
-                if self.splines else 0)
+        return self.errors(t, pt)
     
     def apply(self, data):
-        """Apply this correction profile to 'data'."""
-        for index in data:
-            data.z[index] -= self.error(data.t[index], data.xy[index])
+        """Apply this correction profile to 'data', in place."""
+        data.z -= self.errors(data.t, data.points)
+
+class FixedSchedule:
+    def __init__(self, points, reps):
+        """Schedule 'reps' drift cycles evenly over a scan of 'points' points.
+        
+        The first cycle comes before the first point and the last one after
+        the last point.  With a single rep there is only the first cycle.
+        """
+        self.reps, self.passed, self.durations = reps, 0, []
+        self.interval = points / (reps - 1.) if reps > 1 else numpy.inf
+    
+    def due(self, num, now, drift):
+        """Return whether a drift cycle is due before point number 'num'.
+        
+        Cycles already in 'drift' (when resuming a scan) are not repeated.
+        """
+        if not self.reps or num < self.passed * self.interval: return False
+        self.passed += 1
+        return self.passed > drift.count
+    
+    def final(self, now, drift):
+        """Return whether a drift cycle is due after the last point."""
+        self.passed += 1
+        return self.reps > 1 and self.passed > drift.count
+    
+    def record(self, duration):
+        """Note that a drift cycle took 'duration' seconds."""
+        self.durations.append(duration)
+    
+    def report(self):
+        """Return the cycles run, the cycles a fixed schedule would run,
+        and the estimated seconds saved against it, as a dictionary."""
+        cycle_time = numpy.mean(self.durations) if self.durations else 0.
+        return {'cycles': len(self.durations), 'fixed': self.reps,
+                'cycle_time': cycle_time,
+                'saved': (self.reps - len(self.durations)) * cycle_time}
+
+class AdaptiveSchedule(FixedSchedule):
+    def __init__(self, tolerance, reps=0, probe=60., thermal=None,
+                 sensitivity=None, window=5, noise=None):
+        """Schedule drift cycles when the predicted drift error is too big.
+        
+        Parameters:
+        tolerance -- The largest drift error (um) to let accumulate.
+        reps -- The number of cycles a fixed schedule would have used, for
+            the report only.
+        probe -- Seconds between the first two cycles, which give the first
+            estimate of the drift rate, and the least time between any two.
+        thermal -- A function returning the current temperature, or None.
+        sensitivity -- Drift in um per degree.  If None and 'thermal' is
+            given, it is estimated from the cycles measured so far.
+        window -- The number of recent cycles the drift rate is fitted to.
+        noise -- The noise (um) of the height of a drift point in one
+            cycle.  If None, it is estimated from the fit once there are
+            three cycles.
+        
+        The error predicted since the last cycle is the drift rate (see
+        rate()) times the time elapsed, or the temperature change times the
+        sensitivity if that is larger.  Without drift points, no cycle is
+        ever due.
+        """
+        FixedSchedule.__init__(self, 0, reps)
+        self.tolerance, self.probe = tolerance, probe
+        self.window, self.noise = window, noise
+        self.thermal, self.sensitivity = thermal, sensitivity
+        self.temps = []
+    
+    def heights(self, drift):
+        """Return the height of every drift point in every cycle so far."""
+        xy1 = numpy.column_stack([numpy.reshape(drift.xy, (-1, 2)),
+                                  numpy.ones(len(drift.xy))])
+        return drift.planes().dot(xy1.T)
+    
+    def rate(self, drift):
+        """Return the drift rate (um/s) of the fastest drift point.
+        
+        A line is fitted to the heights of each point over the last
+        'window' cycles, and its slope is reduced by twice its standard
+        error, so that noise alone is not taken for drift.
+        """
+        t = numpy.average(drift.t[:drift.count], axis=1)[-self.window:]
+        h = self.heights(drift)[-self.window:]
+        dt, dh = t - numpy.average(t), h - numpy.average(h, axis=0)
+        slope = dt.dot(dh) / dt.dot(dt)
+        noise = self.noise
+        if noise is None and len(t) > 2:
+            resid = dh - numpy.outer(dt, slope)
+            noise = numpy.sqrt(numpy.sum(resid**2) /
+                               ((len(t) - 2) * resid.shape[1]))
+        error = 0. if noise is None else 2 * noise / numpy.sqrt(dt.dot(dt))
+        return numpy.max(numpy.maximum(abs(slope) - error, 0))
+    
+    def predicted(self, now, drift):
+        """Return the drift error expected to have built up by 'now'."""
+        t = numpy.average(drift.t[:drift.count], axis=1)
+        h = self.heights(drift)
+        error = self.rate(drift) * (now - t[-1])
+        if self.thermal is not None and len(self.temps) == drift.count:
+            sensitivity = self.sensitivity
+            if sensitivity is None and numpy.ptp(self.temps) > 0:
+                piston = numpy.average(h, axis=1)
+                sensitivity = abs(numpy.polyfit(self.temps, piston, 1)[0])
+            if sensitivity is not None:
+                error = max(error, sensitivity *
+                            abs(self.thermal() - self.temps[-1]))
+        return error
+    
+    def due(self, num, now, drift):
+        if not len(drift.xy): return False
+        if drift.count == 0: due = True
+        elif now - numpy.max(drift.t[drift.count-1]) < self.probe: due = False
+        elif drift.count == 1: due = True
+        else: due = self.predicted(now, drift) >= self.tolerance
+        if due and self.thermal is not None:
+            self.temps = self.temps[:drift.count] + [self.thermal()]
+        return due
+    
+    def final(self, now, drift):
+        if not len(drift.xy): return False
+        if self.thermal is not None:
+            self.temps = self.temps[:drift.count] + [self.thermal()]
+        return True
@@ -1,11 +1,66 @@
-from numpy import argsort, sum, square
-from lsst.analysis import utils
+import numpy
+from lsst.analysis import neighbors, utils
 
 class GantryCorrector:
-    def __init__(self, data=None): self.data = data
+    def __init__(self, data=None):
+        """Create a gantry corrector from a map of the gantry error.
+        
+        The correction at a point is the plane through the three closest
+        map points.  The neighbor index over the map is built once here.
+        Corrections asked for one point at a time, such as those of the
+        drift points, are cached per point; a scan keeps the corrections
+        of its own points in an array instead (see errors()).
+        """
+        self.data, self.cache = data, {}
+        self.index = None if data is None else \
+            neighbors.NeighborIndex(data.points)
+    
+    def errors(self, points, chunk=100000):
+        """Return the gantry error at an array of points of shape (..., 2).
+        
+        The points are corrected 'chunk' at a time, to bound the memory
+        used on large scans.
+        """
+        points = numpy.asarray(points, dtype='float')
+        if self.data is None: return numpy.zeros(points.shape[:-1])
+        pts = points.reshape((-1, 2))
+        result = numpy.empty(len(pts))
+        for start in range(0, len(pts), chunk):
+            result[start:start+chunk] = self.plane_errors(
+                pts[start:start+chunk])
+        return result.reshape(points.shape[:-1])
+    
+    def plane_errors(self, pts):
+        """Return the gantry error at an array of points of shape (n, 2)."""
+        closest = self.index.query(pts, 3)
+        xyz = numpy.concatenate([self.index.points[closest],
+            self.data.data['z'].ravel()[closest][...,None]], axis=-1)
+        #The plane through the three points, from the normal to its triangle
+        normal = numpy.cross(xyz[:,1] - xyz[:,0], xyz[:,2] - xyz[:,0])
+        line = abs(normal[:,2]) <= 1e-12 * numpy.sum(abs(normal), axis=-1)
+        result = numpy.empty(len(pts))
+        result[~line] = xyz[~line,0,2] - numpy.sum(normal[~line,:2] *
+            (pts[~line] - xyz[~line,0,:2]), axis=-1) / normal[~line,2]
+        #Collinear points get the least-squares plane, as before
+        for n in numpy.flatnonzero(line):
+            result[n] = utils.evalplane(utils.fitplane(xyz[n,:,:2],
+                                                       xyz[n,:,2]), pts[n])
+        return result
+    
+    def precompute(self, points):
+        """Compute and cache the corrections of a few points for error()."""
+        if self.data is None: return
+        pts = numpy.asarray(points, dtype='float').reshape((-1, 2))
+        self.cache.update(zip(map(tuple, pts.tolist()),
+                              self.errors(pts).tolist()))
+    
     def error(self, pt):
+        """Return the gantry error at one point, from the cache if possible."""
         if self.data is None: return 0.
-        xy, z = self.data.points.reshape((-1, 2)), self.data.data['z'].ravel()
-        closest = argsort(sum(square(xy - pt), axis=-1))[:3]
-        plane = utils.fitplane(xy[closest], z[closest])
-        return utils.evalplane(plane, pt)
+        key = (float(pt[0]), float(pt[1]))
+        if key not in self.cache: self.cache[key] = float(self.errors(key))
+        return self.cache[key]
+    
+    def apply(self, data):
+        """Subtract the gantry error from every point of finished 'data'."""
+        data.z -= self.errors(data.points)
@@ -0,0 +1,144 @@
+"""Point grids that compute their coordinates on demand.
+
+A grid describes the points of a scan without storing them, so defining a
+raster of any size takes constant memory.  A Data object created from a
+grid (see raster_data and tiled_data in data.py) only builds its arrays
+when they are first used, typically when the scan starts.
+
+Properties:
+resolution -- Distance in mm within which index() matches a point.
+
+Classes:
+Grid -- What all grids have in common.
+Raster -- The points of a rectangular grid of x and y coordinates.
+Tiled -- Copies of a grid translated to each of a list of tile origins.
+PointList -- An explicit array of points.
+
+Functions:
+spacing -- Return the step of evenly spaced coordinates, or None.
+locate -- Return the position of a coordinate in a list of them, or None.
+"""
+
+import numpy
+
+resolution = 1e-4
+
+def spacing(values):
+    """Return the step between evenly spaced 'values', or None."""
+    if len(values) < 2: return 1
+    step = (values[-1] - values[0]) / (len(values) - 1.)
+    if step and (abs(numpy.diff(values) - step) < resolution / 10).all():
+        return step
+    return None
+
+def locate(values, v, step=None, order=None):
+    """Return the position of 'v' in 'values', or None if it is not there.
+
+    If the values are evenly spaced by 'step' the position is computed
+    directly; otherwise 'order' (an argsort of the values) is searched.
+    """
+    if step is not None: i = int(round((v - values[0]) / step))
+    else:
+        n = numpy.searchsorted(values[order], v)
+        near = order[max(n - 1, 0):n + 1]
+        i = near[numpy.argmin(abs(values[near] - v))] if len(near) else -1
+    if 0 <= i < len(values) and abs(values[i] - v) <= resolution:
+        return int(i)
+    return None
+
+class Grid:
+    """Points of a given shape, computed instead of stored.
+
+    Every grid has a 'shape' and the methods:
+    point -- Return the (x, y) of the point at an index tuple.
+    index -- Return the index tuple of the point at (x, y), or None.
+    points -- Return all the points as an array of shape shape + (2,).
+    tiles -- Return the tile number of every point, as an array of shape
+        'shape'.
+    """
+    shape = (0,)
+    def __len__(self): return int(numpy.prod(self.shape))
+    def tiles(self): return numpy.zeros(self.shape, dtype='int32')
+
+class Raster(Grid):
+    def __init__(self, x, y):
+        """Create the grid of every (x, y) from two 1-d arrays.
+
+        The grid has shape (len(y), len(x)) like numpy.meshgrid(x, y).
+        Point lookups take constant time if x and y are evenly spaced, and
+        logarithmic time otherwise.
+        """
+        self.x, self.y = numpy.asarray(x), numpy.asarray(y)
+        assert len(self.x.shape) == 1
+        assert len(self.y.shape) == 1
+        self.shape = (len(self.y), len(self.x))
+        self.steps = (spacing(self.x), spacing(self.y))
+        self.orders = [None if step is not None else numpy.argsort(values)
+                       for values, step in zip((self.x, self.y), self.steps)]
+
+    def point(self, index):
+        return numpy.array([self.x[index[1]], self.y[index[0]]])
+
+    def index(self, pt):
+        j = locate(self.x, pt[0], self.steps[0], self.orders[0])
+        i = locate(self.y, pt[1], self.steps[1], self.orders[1])
+        return None if i is None or j is None else (i, j)
+
+    def points(self): return numpy.dstack(numpy.meshgrid(self.x, self.y))
+
+class Tiled(Grid):
+    def __init__(self, origins, grid):
+        """Create the tiles made by translating 'grid' to every origin.
+
+        Parameter 'origins' has shape (tiles, 2) and 'grid' is a Grid or an
+        array of points.  The result has shape grid.shape + (tiles,), and
+        point (..., n) belongs to tile n.  A point lookup tries every tile,
+        so its time does not depend on the size of the grid.
+        """
+        self.origins = numpy.asarray(origins)
+        assert len(self.origins.shape) == 2
+        assert self.origins.shape[1] == 2
+        self.grid = grid if isinstance(grid, Grid) else PointList(grid)
+        self.shape = self.grid.shape + (len(self.origins),)
+
+    def point(self, index):
+        return self.origins[index[-1]] + self.grid.point(index[:-1])
+
+    def index(self, pt):
+        for n, origin in enumerate(self.origins):
+            index = self.grid.index(numpy.subtract(pt, origin))
+            if index is not None: return index + (n,)
+        return None
+
+    def points(self): return self.origins + self.grid.points()[...,None,:]
+
+    def tiles(self):
+        return numpy.tile(numpy.arange(len(self.origins), dtype='int32'),
+                          self.grid.shape + (1,))
+
+class PointList(Grid):
+    def __init__(self, points):
+        """Wrap an array of points with shape (..., 2).
+
+        Point lookups go through a hash table of the points rounded to
+        'resolution', built on the first lookup.
+        """
+        self.array = numpy.asarray(points)
+        assert self.array.shape[-1] == 2
+        self.shape = self.array.shape[:-1]
+        self.table = None
+
+    def point(self, index): return self.array[index]
+
+    def index(self, pt):
+        if self.table is None:
+            keys = numpy.round(self.array.reshape((-1, 2)) / resolution)
+            self.table = {}
+            for flat, key in enumerate(map(tuple, keys.tolist())):
+                self.table.setdefault(key, flat)
+        flat = self.table.get(tuple(numpy.round(numpy.divide(pt,
+                                                resolution)).tolist()))
+        if flat is None: return None
+        return tuple(int(i) for i in numpy.unravel_index(flat, self.shape))
+
+    def points(self): return self.array
@@ -0,0 +1,157 @@
+"""Scan path planning.
+
+The visit order of a scan is computed once, before the first stage move,
+so the acquisition loop only has to look up the next index.
+
+Classes:
+Path -- A planned visit order with travel distance and time estimates.
+
+Functions:
+serpentine -- Boustrophedon order for a raster grid.
+greedy -- Nearest-neighbor order for an arbitrary set of points.
+two_opt -- Improve an order by reversing segments that shorten it.
+nearest -- Nearest-neighbor order followed by 2-opt improvement.
+tiled -- Visit tiles one at a time, each in nearest-neighbor order.
+plan -- Choose one of the above for a Data object.
+"""
+
+import numpy
+from scipy.spatial import cKDTree
+from lsst.acquisition import grid
+from lsst.analysis import utils
+
+class Path:
+    def __init__(self, points, order, start=(0, 0)):
+        """Create a path visiting 'points' (shape (n, 2)) in 'order'.
+
+        Parameter 'start' is the stage position before the first move.
+        """
+        self.points = numpy.asarray(points, dtype='float').reshape((-1, 2))
+        self.order = numpy.asarray(order, dtype='int')
+        self.start = numpy.asarray(start, dtype='float')
+
+    def __len__(self): return len(self.order)
+    def __iter__(self): return iter(self.order)
+
+    def legs(self):
+        """Return the (dx, dy) of every move along the path."""
+        return numpy.diff(numpy.vstack([self.start, self.points[self.order]]),
+                          axis=0)
+
+    def distance(self):
+        """Return the total travel distance along the path."""
+        return numpy.sum(numpy.hypot(*self.legs().T))
+
+    def time(self, velocity=600, settle=0.):
+        """Estimate the time spent moving along the path, in seconds.
+
+        X and Y move together at 'velocity' each, so a move lasts as long
+        as its longer axis; 'settle' is added for every point.
+        """
+        return (numpy.sum(numpy.max(abs(self.legs()), axis=-1)) / velocity
+                + settle*len(self))
+
+    def __str__(self):
+        return ('Path of {0} points, {1:.1f} mm, about {2:.1f} s of motion'
+                .format(len(self), self.distance(), self.time()))
+
+def serpentine(shape):
+    """Return the flat visit order for a grid of the given (rows, columns).
+
+    Even rows are visited left to right and odd rows right to left.
+    """
+    order = numpy.arange(int(numpy.prod(shape))).reshape(shape)
+    order[1::2] = order[1::2,::-1]
+    return order.ravel()
+
+def greedy(points, start=(0, 0)):
+    """Return the nearest-neighbor visit order of 'points' (shape (n, 2)).
+
+    At each step, go to the closest point remaining.  The k-d tree is
+    rebuilt over the remaining points whenever half of it has been visited.
+    """
+    points = numpy.asarray(points, dtype='float').reshape((-1, 2))
+    done = numpy.zeros(len(points), dtype='bool')
+    order = numpy.empty(len(points), dtype='int')
+    members, cur, used = numpy.arange(len(points)), start, 0
+    tree = cKDTree(points)
+    for n in range(len(points)):
+        if 2*used > len(members):
+            members = members[~done[members]]
+            tree, used = cKDTree(points[members]), 0
+        k = 1
+        while True:
+            closest = members[numpy.atleast_1d(
+                    tree.query(cur, min(k, len(members)))[1])]
+            closest = closest[~done[closest]]
+            if len(closest): break
+            k *= 2
+        order[n] = closest[0]
+        done[closest[0]], cur, used = True, points[closest[0]], used + 1
+    return order
+
+def two_opt(points, order, start=(0, 0), window=50, passes=2):
+    """Shorten a visit order by reversing segments of it.
+
+    Only segments of up to 'window' points are considered, so one pass
+    costs O(n * window).  The path is open: it starts at 'start' and may
+    end anywhere.
+    """
+    points = numpy.asarray(points, dtype='float').reshape((-1, 2))
+    order = numpy.array(order, dtype='int')
+    dist = lambda a, b: numpy.hypot(*(a - b).T)
+    for p in range(passes):
+        improved = False
+        for i in range(len(order) - 1):
+            prev = points[order[i-1]] if i else numpy.asarray(start)
+            js = numpy.arange(i + 1, min(i + 1 + window, len(order)))
+            after = numpy.minimum(js + 1, len(order) - 1)
+            old = dist(prev, points[order[i]]) + numpy.where(js + 1 <
+                len(order), dist(points[order[js]], points[order[after]]), 0)
+            new = dist(prev, points[order[js]]) + numpy.where(js + 1 <
+                len(order), dist(points[order[i]], points[order[after]]), 0)
+            best = numpy.argmax(old - new)
+            if old[best] - new[best] > 1e-9:
+                order[i:js[best]+1] = order[i:js[best]+1][::-1].copy()
+                improved = True
+        if not improved: break
+    return order
+
+def nearest(points, start=(0, 0), window=50, passes=2):
+    """Return a nearest-neighbor order of 'points', improved by 2-opt."""
+    return two_opt(points, greedy(points, start), start, window, passes)
+
+def tiled(points, tiles, start=(0, 0), **kwargs):
+    """Return a visit order that finishes each tile before the next.
+
+    Tiles are visited in nearest-neighbor order of their centroids, and the
+    points of each tile in nearest() order from where the last tile ended.
+    """
+    points = numpy.asarray(points, dtype='float').reshape((-1, 2))
+    tiles = numpy.asarray(tiles).ravel()
+    order = numpy.argsort(tiles, kind='mergesort')
+    groups = (numpy.split(order, numpy.flatnonzero(numpy.diff(tiles[order]))
+                          + 1) if len(order) else [])
+    centers = [numpy.average(points[g], axis=0) for g in groups]
+    order, cur = [], start
+    for tnum in greedy(centers, start):
+        group = groups[tnum]
+        order.append(group[nearest(points[group], cur, **kwargs)])
+        cur = points[order[-1][-1]]
+    return numpy.concatenate(order) if order else numpy.empty(0, 'int')
+
+def plan(data, start=(0, 0)):
+    """Plan the visit order of a Data object and return a Path.
+
+    Tiled data is visited tile by tile, raster grids (see utils.isgrid) in
+    serpentine order and anything else in nearest() order.
+    """
+    points = data.points.reshape((-1, 2))
+    if len(data.tile_index()[0]) > 1:
+        order = tiled(points, data.data["tiles"], start)
+    elif isinstance(data.grid, grid.Raster) or (len(data.shape) == 2 and
+                                                utils.isgrid(data.points)):
+        order = serpentine(data.shape)
+    else:
+        order = nearest(points, start)
+    return Path(points, order, start)
@@ -0,0 +1,130 @@
+"""Pipelined acquisition: overlap host work with stage moves and sensing.
+
+A plain scan does, for every point: move, wait, integrate, query, then the
+bookkeeping (gantry correction, logging, storing) before the next move is
+even issued.  The Pipeline keeps the stage and sensor strictly in order -
+the stage never moves while a point is being measured - but:
+
+- the sensor is driven by a worker thread that owns the serial link, so
+  the integration wait and query of point i run while the main thread does
+  the bookkeeping of point i-1;
+- the move to point i+1 is issued as soon as the reading of point i is in,
+  before any of its bookkeeping.
+
+Every point's latency is broken down into its phases, see Pipeline.report.
+
+Classes:
+SensorWorker -- Thread that performs sensor measurements in order.
+Pipeline -- Runs a sequence of measurement jobs with the above overlaps.
+"""
+
+import threading
+import time
+import numpy
+
+try: import queue
+except ImportError: import Queue as queue
+
+phases = ['move', 'issue', 'measure', 'bookkeeping']
+
+class Request:
+    def __init__(self, out):
+        self.out, self.done = out, threading.Event()
+        self.value = self.error = None
+    def result(self):
+        """Wait for the measurement and return (time, value)."""
+        self.done.wait()
+        if self.error is not None: raise self.error
+        return self.value
+
+class SensorWorker(threading.Thread):
+    def __init__(self, sensor):
+        """Create a worker for 'sensor', a module like drivers.keyence."""
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sensor, self.requests = sensor, queue.Queue()
+
+    def submit(self, out=1):
+        """Queue a blocking measurement and return its Request."""
+        request = Request(out)
+        self.requests.put(request)
+        return request
+
+    def stop(self):
+        self.requests.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            request = self.requests.get()
+            if request is None: return
+            try:
+                z = self.sensor.measure(request.out, blocking=True)
+                request.value = (time.time(), z)
+            except Exception as e:
+                request.error = e
+            request.done.set()
+
+class Pipeline:
+    def __init__(self, stage=None, sensor=None, velocity=600):
+        """Create a pipeline for a stage and sensor.
+
+        Parameters 'stage' and 'sensor' are modules with the interfaces of
+        drivers.a3200 and drivers.keyence (or simulations of them), and
+        default to those drivers.
+        """
+        if stage is None: from lsst.drivers import a3200 as stage
+        if sensor is None: from lsst.drivers import keyence as sensor
+        self.stage, self.sensor, self.velocity = stage, sensor, velocity
+        self.stats = numpy.zeros((0, len(phases)))
+
+    def run(self, jobs):
+        """Measure a sequence of jobs.
+
+        Parameter 'jobs' is an iterable of (pt, store) pairs: 'pt' is where
+        to measure and store(t, z) is called with the raw time and reading.
+        The iterable is only advanced once the stage is at rest and no
+        measurement is outstanding, so it may use the stage itself (for
+        example to run a drift cycle) before yielding the next job.
+        """
+        worker, stats = SensorWorker(self.sensor), []
+        worker.start()
+        try:
+            jobs, pending = iter(jobs), None
+            job = next(jobs, None)
+            if job is not None: self.move(job[0])
+            while job is not None:
+                t0 = time.time()
+                self.stage.wait([self.stage.x, self.stage.y])
+                request, t1 = worker.submit(), time.time()
+                if pending is not None: pending[0](*pending[1])
+                t2 = time.time()
+                reading, t3 = request.result(), time.time()
+                nxt = next(jobs, None)
+                t4 = time.time()
+                if nxt is not None: self.move(nxt[0])
+                t5 = time.time()
+                stats.append((t1 - t0, t5 - t4, t3 - t2, t2 - t1))
+                job, pending = nxt, (job[1], reading)
+            if pending is not None: pending[0](*pending[1])
+        finally:
+            worker.stop()
+            self.stats = numpy.vstack([self.stats] +
+                                      [numpy.reshape(stats, (-1, 4))])
+
+    def move(self, pt):
+        self.stage.xymove(pt, velocity=self.velocity, blocking=False)
+
+    def report(self):
+        """Return the mean time per point spent waiting in each phase.
+
+        'move' is the wait for the stage, 'issue' the time to command the
+        next move, 'measure' the wait for the sensor beyond what the
+        bookkeeping of the previous point already covered, and
+        'bookkeeping' that host work itself.
+        """
+        means = (numpy.mean(self.stats, axis=0) if len(self.stats)
+                 else numpy.zeros(len(phases)))
+        report = dict(zip(phases, means))
+        report['total'] = numpy.sum(means)
+        return report
@@ -1,35 +1,186 @@
 from __future__ import division
 
 from lsst.drivers import a3200, keyence
-from lsst.acquisition import drift_correct, gantry_correct
-import numpy, time, sys
+from lsst.acquisition import drift_correct, gantry_correct, scanlog, sweep
+from lsst.analysis import utils
+import itertools, numpy, time, sys
 
 class Scan:
+    velocity = 600
+    
     def __init__(self, data, drift=drift_correct.DriftCorrector(),
-                 gantry=gantry_correct.GantryCorrector()):
-        """Create a scan object."""
+                 gantry=gantry_correct.GantryCorrector(), log=None,
+                 schedule=None, telemetry=None, readback=False):
+        """Create a scan object.
+        
+        If 'log' is given, every measurement is appended to the scan log at
+        that path as it is made.  If the log already exists, the scan resumes
+        from it and skips the points that were already measured.
+        
+        Parameter 'schedule' decides when drift cycles are run (see
+        drift_correct.py); by default, drift.reps cycles evenly spaced.
+        
+        If a running telemetry.Telemetry is given, its readings are added
+        to the data as columns once the scan is finished.
+        
+        The plane fit of the points measured so far is kept up to date in
+        self.flatness (a utils.PlaneSums, centered on the data), so its
+        stats() can be followed while the scan runs.
+        
+        The gantry error of every data point is computed in one call when
+        the first point is corrected, and kept in self.corrections, a flat
+        array; nothing is computed over the points of a lazy grid before
+        the scan runs.
+        
+        If 'readback' is true, the encoder position of the stage at every
+        point measured by run() without a pipeline (or by the queued
+        programs of simulator.queue) is recorded in the columns
+        "x_actual" and "y_actual" of the data.
+        """
         self.data, self.drift, self.gantry = data, drift, gantry
-        self.dfreq = len(self.data) / (self.drift.reps - 1)
+        self.telemetry, self.readback = telemetry, readback
+        self.actual = (numpy.nan, numpy.nan)
+        if readback:
+            from lsst.acquisition.data import emptynan
+            for name in ["x_actual", "y_actual"]:
+                if name not in data.data:
+                    data.data[name] = emptynan(data.shape)
+        self.corrections = None
+        if self.gantry: self.gantry.precompute(self.drift.xy)
+        self.schedule = (drift_correct.FixedSchedule(len(data), drift.reps)
+                         if schedule is None else schedule)
+        self.logpath = log
+        self.log = None if log is None else scanlog.ScanLog(log, data)
+        self.done = (self.log.restore(data, drift) if self.log else
+                     numpy.zeros(len(self.data), dtype='bool'))
+        if len(data):
+            first, last = [data.point(numpy.unravel_index(n, data.shape))
+                           for n in (0, len(data) - 1)]
+            origin = (first + last) / 2.
+        else: origin = (0, 0)
+        self.flatness = utils.PlaneSums(origin)
+        if self.done.any():
+            self.flatness.add(self.data.points.reshape((-1, 2))[self.done],
+                              self.data.z.ravel()[self.done])
     
     def step(self, pt):
         """Measure one point and return (time, z-value)."""
-        a3200.xymove(pt, velocity=600, blocking=True)
+        return self.correct(pt, *self.raw_step(pt))
+    
+    def raw_step(self, pt):
+        """Measure one point and return the time and the raw sensor value."""
+        a3200.xymove(pt, velocity=self.velocity, blocking=True)
+        if self.readback: self.actual = a3200.xyposition()
         z = keyence.measure(blocking=True)
-        if self.gantry and z: z -= self.gantry.error(pt)
-        return (time.time(), z if z else numpy.nan)
+        return time.time(), z
+    
+    def correct(self, pt, t, z, flat=None):
+        """Apply the gantry correction to a raw value; return (time, z).
+        
+        If 'flat' is the flat index of a data point, its correction is
+        taken from self.corrections.
+        """
+        if self.gantry and z:
+            z -= (self.gantry.error(pt) if flat is None
+                  else self.gantry_errors()[flat])
+        return (t, z if z else numpy.nan)
+    
+    def gantry_errors(self):
+        """Return self.corrections, computing it on first use."""
+        if self.corrections is None:
+            self.corrections = self.gantry.errors(self.data.points).ravel()
+        return self.corrections
     
-    def run(self):
-        """Run this scan, including drift correction and gantry correction."""
-        sys.stdout.write('00%')
+    def record(self, kind, index, tz):
+        """Append a measurement to the scan log, if any, and return it."""
+        if self.log: self.log.append(kind, index, *tz)
+        return tz
+    
+    def drift_step(self):
+        """Return a step function for the next drift cycle that logs it."""
+        n = itertools.count(self.drift.count * len(self.drift.xy))
+        return lambda pt: self.record(scanlog.DRIFT, next(n), self.step(pt))
+    
+    def drift_cycle(self):
+        """Run one drift cycle, logging it and timing it for the schedule."""
+        start = time.time()
+        self.drift.cycle(self.drift_step())
+        self.schedule.record(time.time() - start)
+    
+    def store(self, index, flat):
+        """Return a function storing the raw (t, z) of data point 'index'."""
+        def store(t, z):
+            pt = self.data.points[index]
+            self.data.data['t'][index], self.data.data['z'][index] = \
+                self.record(scanlog.POINT, flat, self.correct(pt, t, z, flat))
+            self.flatness.add(pt, self.data.data['z'][index])
+            if self.readback:
+                self.data.data['x_actual'][index], \
+                    self.data.data['y_actual'][index] = self.actual
+            self.done[flat] = True
+        return store
+    
+    def jobs(self, before_drift=None):
+        """Yield (point, store function) for every point left to measure.
+        
+        Drift cycles are run between points as they fall due, after calling
+        before_drift() if it is given, and the progress is written to
+        stdout.
+        """
         for num, index in enumerate(self.data):
             sys.stdout.write('\b\b\b{0:02d}%'.format(
                     (100*num)//len(self.data)))
-            if num % self.dfreq < 1: self.drift.cycle(self.step)
-            self.data.data['t'][index], self.data.data['z'][index] = \
-                self.step(self.data.points[index])
-        self.drift.cycle(self.step)
+            if self.schedule.due(num, time.time(), self.drift):
+                if before_drift: before_drift()
+                self.drift_cycle()
+            flat = numpy.ravel_multi_index(index, self.data.shape)
+            if not self.done[flat]:
+                yield self.data.points[index], self.store(index, flat)
+        if self.schedule.final(time.time(), self.drift):
+            if before_drift: before_drift()
+            self.drift_cycle()
+    
+    def run(self, pipeline=None):
+        """Run this scan, including drift correction and gantry correction.
+        
+        If a pipeline.Pipeline is given, the points are measured through it,
+        overlapping stage moves with the host's work between points.
+        """
+        self.open_log()
+        try:
+            sys.stdout.write('00%')
+            if pipeline is not None: pipeline.run(self.jobs())
+            else:
+                for pt, store in self.jobs(): store(*self.raw_step(pt))
+        finally: self.close_log()
+        if self.telemetry: self.data.join(self.telemetry)
         sys.stdout.write('\b\b\b100%')
     
+    def sweep(self, velocity=1.):
+        """Run this scan as continuous sweeps along X; see sweep.py."""
+        self.open_log()
+        try: sweep.run(self, velocity)
+        finally: self.close_log()
+        if self.telemetry: self.data.join(self.telemetry)
+    
+    def open_log(self):
+        """Reopen the scan log, if any, after an earlier run closed it."""
+        if self.log and self.log.out.closed:
+            self.log = scanlog.ScanLog(self.logpath, self.data)
+    
+    def close_log(self):
+        """Write out and close the scan log, if any.
+        
+        Every way of running the scan closes the log when it returns or
+        raises, so the file can be moved or deleted right away.
+        """
+        if self.log and not self.log.out.closed: self.log.close()
+    
+    def save(self, path):
+        """Save the scanned data to a binary scan file."""
+        self.data.save(path, dict(self.data.meta, points=len(self.data),
+            saved=time.strftime('%Y-%m-%d %H:%M:%S')))
+    
     def write(self, out):
         out.write(time.strftime('# Scan of {0} points'.format(len(self.data))
                                 + ' from %Y-%m-%d at %H:%M:%S\n'))
@@ -0,0 +1,107 @@
+"""Binary columnar scan files.
+
+A scan file holds every column of a Data object at full precision and is
+memory-mapped on reading, so loading costs the same for any number of
+points.  The layout is:
+
+  8 bytes   magic string 'LSSTSCAN'
+  4 bytes   header length in bytes, little-endian unsigned
+  header    JSON object, padded with spaces to a multiple of 8 bytes
+  columns   one contiguous little-endian array per column, each padded to
+            a multiple of 8 bytes, in the order listed in the header
+
+The header records the format version, the Data shape, the columns as
+[name, dtype, components, offset] (offset counted from the end of the
+header) and a free-form "meta" dictionary.  The points are stored as one
+column of 2 components, (x, y), so they map straight onto Data.points.
+
+Functions:
+write -- Write a Data object to a scan file, a chunk at a time.
+read -- Memory-map a scan file into a Data object.
+header -- Return the header of a scan file.
+is_scanfile -- Whether a file is a scan file.
+"""
+
+import json
+import struct
+import numpy
+
+magic = b'LSSTSCAN'
+version = 1
+extension = '.scan'
+
+def pad(n): return -n % 8
+
+def columns(data):
+    """Return the (name, array) pairs stored for a Data object."""
+    return ([("points", data.points.reshape((-1, 2)))] +
+            [(name, data.data[name].ravel()) for name in sorted(data.data)])
+
+def write(data, path, meta=None, chunk=1<<18):
+    """Write 'data' to a scan file at 'path'.
+
+    Parameter 'meta' is a dictionary of JSON-serializable metadata.
+    Columns are converted and written 'chunk' points at a time, so no
+    full-size temporary copy is ever made.
+    """
+    cols, offset = [], 0
+    for name, arr in columns(data):
+        dtype = arr.dtype.newbyteorder('<')
+        comps = arr.shape[1] if arr.ndim > 1 else 1
+        cols.append([name, dtype.str, comps, offset])
+        size = arr.shape[0] * comps * dtype.itemsize
+        offset += size + pad(size)
+    head = json.dumps({"version": version, "shape": list(data.shape),
+                       "columns": cols, "meta": meta or {}}).encode('ascii')
+    head += b' ' * pad(len(head) + len(magic) + 4)
+    out = open(path, 'wb')
+    try:
+        out.write(magic + struct.pack('<I', len(head)) + head)
+        for (name, arr), (_, dtype, comps, start) in zip(columns(data), cols):
+            for n in range(0, len(arr), chunk):
+                out.write(numpy.ascontiguousarray(arr[n:n+chunk],
+                                                  dtype=dtype).tobytes())
+            size = len(arr) * comps * numpy.dtype(dtype).itemsize
+            out.write(b'\0' * pad(size))
+    finally:
+        out.close()
+
+def header(path):
+    """Return (header dictionary, byte offset of the first column)."""
+    f = open(path, 'rb')
+    try:
+        if f.read(len(magic)) != magic:
+            raise IOError(path + ' is not a scan file')
+        length = struct.unpack('<I', f.read(4))[0]
+        head = json.loads(f.read(length).decode('ascii'))
+    finally:
+        f.close()
+    if head["version"] > version:
+        raise IOError('{0} has scan file version {1}, newer than {2}'
+                      .format(path, head["version"], version))
+    return head, len(magic) + 4 + length
+
+def is_scanfile(path):
+    f = open(path, 'rb')
+    try: return f.read(len(magic)) == magic
+    finally: f.close()
+
+def read(path, mode='c'):
+    """Memory-map the scan file at 'path' into a Data object.
+
+    No data is copied: the arrays of the result are views of the file.
+    With the default mode 'c' they may be modified in memory without
+    changing the file; mode 'r' makes them read-only.
+    """
+    from lsst.acquisition.data import Data
+    head, start = header(path)
+    shape, count = tuple(head["shape"]), int(numpy.prod(head["shape"]))
+    dnew = Data()
+    for name, dtype, comps, offset in head["columns"]:
+        arr = (numpy.memmap(path, dtype=dtype, mode=mode, offset=start+offset,
+                            shape=(count, comps) if comps > 1 else (count,))
+               if count else numpy.empty((0, comps), dtype=dtype))
+        if name == "points": dnew.points = arr.reshape(shape + (2,))
+        else: dnew.data[name] = arr.reshape(shape)
+    dnew.meta = head["meta"]
+    return dnew
@@ -0,0 +1,121 @@
+"""Append-only scan logs, so that an interrupted scan can be resumed.
+
+Every measurement made during Scan.run is appended to the log as a fixed
+size record (kind, index, time, z-value).  Records are buffered and
+written, flushed and synced to disk a batch at a time.  A torn record at
+the end of the file, left by a crash in the middle of a write, is dropped
+when the log is reopened.
+
+The file starts with the 8 byte magic string 'LSSTSLOG', a 4 byte
+little-endian header length and a JSON header recording the shape of the
+scanned Data and a checksum of its points, so a log is never resumed
+against a different scan.
+
+Properties:
+record -- The numpy dtype of one record.
+POINT, DRIFT -- Record kinds: a data point, or a drift correction point.
+
+Classes:
+ScanLog -- An open scan log.
+
+Functions:
+read -- Return the header and all complete records of a log file.
+"""
+
+import json
+import os
+import struct
+import zlib
+import numpy
+
+magic = b'LSSTSLOG'
+record = numpy.dtype([('kind', '<i4'), ('index', '<i4'),
+                      ('t', '<f8'), ('z', '<f8')])
+POINT, DRIFT = 0, 1
+
+def checksum(data):
+    points = numpy.ascontiguousarray(data.points, dtype='<f8')
+    return zlib.crc32(points.tobytes()) & 0xffffffff
+
+def read(path):
+    """Return (header, records, byte offset of the first record)."""
+    f = open(path, 'rb')
+    try:
+        if f.read(len(magic)) != magic:
+            raise IOError(path + ' is not a scan log')
+        length = struct.unpack('<I', f.read(4))[0]
+        head = json.loads(f.read(length).decode('ascii'))
+        raw = f.read()
+    finally:
+        f.close()
+    count = len(raw) // record.itemsize
+    return (head, numpy.frombuffer(raw[:count*record.itemsize], dtype=record),
+            len(magic) + 4 + length)
+
+class ScanLog:
+    def __init__(self, path, data, batch=64, sync=True):
+        """Open the log at 'path' for a scan of 'data', creating it if needed.
+
+        Parameter 'batch' is the number of records buffered between writes.
+        Parameter 'sync' is whether each write is also synced to the disk.
+        """
+        self.path, self.batch, self.sync = path, batch, sync
+        self.buffer = numpy.zeros(batch, dtype=record)
+        self.pending = 0
+        head = {"shape": list(data.shape), "checksum": checksum(data)}
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            old, self.records, start = read(path)
+            if old != head:
+                raise IOError(path + ' is the log of a different scan')
+            self.out = open(path, 'r+b')
+            self.out.truncate(start + len(self.records)*record.itemsize)
+            self.out.seek(0, 2)
+        else:
+            self.records = numpy.zeros(0, dtype=record)
+            text = json.dumps(head).encode('ascii')
+            self.out = open(path, 'wb')
+            self.out.write(magic + struct.pack('<I', len(text)) + text)
+            self.out.flush()
+
+    def append(self, kind, index, t, z):
+        """Log one measurement, writing the batch out once it is full."""
+        self.buffer[self.pending] = (kind, index, t, z)
+        self.pending += 1
+        if self.pending == self.batch: self.flush()
+
+    def flush(self):
+        """Write all buffered records to disk."""
+        if self.pending:
+            self.out.write(self.buffer[:self.pending].tobytes())
+            self.pending = 0
+        self.out.flush()
+        if self.sync: os.fsync(self.out.fileno())
+
+    def close(self):
+        self.flush()
+        self.out.close()
+
+    def restore(self, data, drift=None):
+        """Copy the logged measurements back into 'data' and 'drift'.
+
+        Only complete drift cycles are restored; an interrupted cycle is
+        measured again.  Returns a flat boolean array marking the points of
+        'data' that have already been measured.
+        """
+        done = numpy.zeros(len(data), dtype='bool')
+        points = self.records[self.records['kind'] == POINT]
+        data.data['t'].flat[points['index']] = points['t']
+        data.data['z'].flat[points['index']] = points['z']
+        done[points['index']] = True
+        if drift is not None and len(drift.xy):
+            cycles = self.records[self.records['kind'] == DRIFT]
+            if len(cycles):
+                drift.grow(cycles['index'].max() // len(drift.xy) + 1)
+            seen = numpy.zeros(drift.t.shape, dtype='bool')
+            seen.flat[cycles['index']] = True
+            drift.t.flat[cycles['index']] = cycles['t']
+            drift.z.flat[cycles['index']] = cycles['z']
+            complete = numpy.append(seen.all(axis=1), False)
+            drift.count = int(numpy.argmin(complete))
+            drift.calc(drift.count)
+        return done
@@ -0,0 +1,132 @@
+"""On-the-fly profiling: measure while the stage moves.
+
+Instead of stopping at every point, the X axis sweeps along each row of
+constant Y at a steady velocity while a background thread samples the
+sensor as fast as it answers.  The actual X position of the stage is read
+between readings and interpolated to the time of each reading, so rows
+swept in opposite directions line up.  The profile of each sweep is then
+interpolated at the requested points of the row.
+
+Classes:
+Sampler -- Thread recording (time, x, z) samples until stopped.
+
+Functions:
+line -- Sweep one row and return its samples.
+resample -- Interpolate swept samples at given X positions.
+rows -- Group the points of a Data object into rows of constant Y.
+run -- Measure a whole Scan by sweeping, with its drift cycles.
+"""
+
+import threading
+import time
+import numpy
+
+class Sampler(threading.Thread):
+    def __init__(self, axis, sensor, out=1):
+        """Sample 'sensor' and the position of 'axis' until stopped.
+
+        The time of a reading is the middle of the sensor.measure() call
+        less sensor.delay (see keyence.py), if the sensor has one.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.axis, self.sensor, self.out = axis, sensor, out
+        self.delay = getattr(sensor, 'delay', 0.)
+        self.stopped, self.samples = threading.Event(), []
+
+    def position(self):
+        """Return the time and the position of the axis.
+
+        The time is the middle of the call reading the position.
+        """
+        t0 = time.time()
+        x = self.axis.position()
+        return (t0 + time.time())/2, x
+
+    def run(self):
+        before = self.position()
+        while not self.stopped.is_set():
+            t0 = time.time()
+            z = self.sensor.measure(self.out)
+            t = (t0 + time.time())/2 - self.delay
+            after = self.position()
+            x = before[1] + ((after[1] - before[1]) * (t - before[0]) /
+                             (after[0] - before[0]))
+            self.samples.append((t, x, numpy.nan if z is None else z))
+            before = after
+
+    def wait(self, count):
+        """Wait until at least 'count' samples have been recorded."""
+        while len(self.samples) < count and self.is_alive(): time.sleep(.001)
+
+    def stop(self):
+        """Stop sampling and return the samples as an array of (t, x, z).
+
+        At least one sample started after this call is included, so the
+        final position of the stage is always covered.
+        """
+        self.wait(len(self.samples) + 2)
+        self.stopped.set()
+        self.join()
+        return numpy.reshape(self.samples, (-1, 3))
+
+def line(y, x0, x1, velocity=1., stage=None, sensor=None):
+    """Sweep from (x0, y) to (x1, y) at 'velocity' in mm/s.
+
+    The sampler runs from before the move starts until after it ends, so
+    both ends of the row are covered.  Returns an array of (t, x, z).
+    """
+    if stage is None: from lsst.drivers import a3200 as stage
+    if sensor is None: from lsst.drivers import keyence as sensor
+    stage.xymove((x0, y), blocking=True)
+    sampler = Sampler(stage.x, sensor)
+    sampler.start()
+    sampler.wait(1)
+    try: stage.x.move(x1, velocity, blocking=True)
+    finally: samples = sampler.stop()
+    return samples
+
+def resample(samples, x):
+    """Interpolate the time and z-value of swept samples at positions 'x'.
+
+    A point is dark (nan) if it lies next to a dark sample or outside the
+    swept range.  Returns arrays (t, z) shaped like 'x'.
+    """
+    samples = samples[numpy.argsort(samples[:,1], kind='mergesort')]
+    xs, dark = samples[:,1], numpy.isnan(samples[:,2])
+    t = numpy.interp(x, xs, samples[:,0])
+    z = (numpy.interp(x, xs[~dark], samples[~dark,2]) if (~dark).any()
+         else numpy.nan * numpy.ones(numpy.shape(x)))
+    z[(numpy.interp(x, xs, dark.astype('float')) > 0) |
+      (x < xs[0]) | (x > xs[-1])] = numpy.nan
+    return t, z
+
+def rows(data):
+    """Return a list of flat index arrays, one per distinct Y coordinate."""
+    y = data.points[...,1].ravel()
+    order = numpy.argsort(y, kind='mergesort')
+    return numpy.split(order, numpy.flatnonzero(numpy.diff(y[order])) + 1)
+
+def run(scan, velocity=1., stage=None, sensor=None):
+    """Measure the data of 'scan' by sweeping its rows.
+
+    Rows are swept in alternating directions.  The scan's drift schedule
+    is consulted before every row, with the number of points swept so far,
+    and once more at the end.  Points that were already measured (when
+    resuming from a scan log) are not stored.
+    """
+    data, swept = scan.data, 0
+    xy = data.points.reshape((-1, 2))
+    for n, row in enumerate(rows(data)):
+        if scan.schedule.due(swept, time.time(), scan.drift):
+            scan.drift_cycle()
+        x = xy[row, 0]
+        ends = (x.min(), x.max())[::(-1 if n % 2 else 1)]
+        samples = line(xy[row[0], 1], ends[0], ends[1], velocity, stage,
+                       sensor)
+        for flat, t, z in zip(row, *resample(samples, x)):
+            if not scan.done[flat]:
+                scan.store(numpy.unravel_index(flat, data.shape), flat)(t, z)
+        swept += len(row)
+    if scan.schedule.final(time.time(), scan.drift): scan.drift_cycle()
+    if scan.log: scan.log.flush()
@@ -1 +1,2 @@
-__all__ = ['outlier', 'utils', 'plot', 'smoothing']
+__all__ = ['neighbors', 'outlier', 'utils', 'parallel', 'plot',
+           'smoothing', 'surface']
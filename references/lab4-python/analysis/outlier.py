@@ -1,24 +1,34 @@
 import numpy
-from lsst.analysis import utils
+from lsst.analysis import neighbors
 
 """
 Detection algorithm:
   for every point, select the X closest
   if current point is sufficiently far from local median, throw it out
+
+The X closest points of every point are found in one bulk query against a
+k-d tree (see neighbors.py), and all local medians are computed at once.
 """
 
-def valid(d, ix=None, numpoints=10, std_tol=1.5):
-    ix = numpy.ones(d.shape, dtype='bool') if ix is None else ix
-    valid = numpy.ones(d.shape, dtype='bool')
+def valid(d, ix=None, numpoints=10, std_tol=1.5, index=None):
+    """Return a boolean array marking the points of 'd' that are not outliers.
+
+    Parameter 'ix' restricts the neighbors to a mask of 'd', such as a tile.
+    Parameter 'index' is a prebuilt neighbors.NeighborIndex for 'ix'.
+    """
+    index = neighbors.NeighborIndex(d.points, ix) if index is None else index
+    z = d.z.ravel()
     max_dev = std_tol * numpy.std(d.z)
-    for i in d:
-        dists = numpy.where(ix,
-                            numpy.sum((d.points-d.points[i])**2, axis=-1),
-                            numpy.inf)                
-        closest = []
-        for j in range(numpoints):
-            imin = numpy.argmin(dists)
-            closest.append(imin)
-            dists[imin] = numpy.inf
-        valid[i] = abs(numpy.median(d.z[closest]) - d.z[i]) < max_dev
-    return valid
+    closest = index.query(numpoints=numpoints)
+    return (abs(numpy.median(z[closest], axis=-1) - z) < max_dev
+            ).reshape(d.shape)
+
+def deviations(d, index, numpoints=10):
+    """Return how far each point of 'index' lies from its local median.
+
+    Only the members of the neighbors.NeighborIndex 'index' (such as the
+    points of one tile) are queried, so the cost is that of the index.
+    """
+    z = d.z.ravel()
+    closest = index.query(index.points[index.members], numpoints)
+    return abs(numpy.median(z[closest], axis=-1) - z[index.members])
@@ -0,0 +1,105 @@
+"""Per-tile analysis across a pool of processes.
+
+The tiles of a scan are independent, so outlier removal and plane and
+spline fits can run on all of them at once.  The data is written once to a
+temporary scan file (see acquisition/scanfile.py) which every worker
+memory-maps read-only, so only tile numbers are sent to the workers and
+only the results of each tile are sent back.
+
+Functions:
+map_tiles -- Run a function on every tile of a Data object in parallel.
+remove_outliers -- Parallel equivalent of Data.remove_outliers.
+planes -- Return the best-fit plane of every tile.
+planarize -- Subtract from every tile its own best-fit plane.
+plane_sums -- Return the plane fit sums of every tile, for merging.
+splines -- Return the best-fit spline of every tile.
+"""
+
+import os
+import tempfile
+import numpy
+
+opened = {} # the scan file memory-mapped by this worker process
+
+def run_tile(path, func, tnum, kwargs):
+    if path not in opened:
+        from lsst.acquisition import scanfile
+        opened.clear()
+        opened[path] = scanfile.read(path, mode='r')
+    return func(opened[path].tile(tnum), **kwargs)
+
+def map_tiles(data, func, workers=None, **kwargs):
+    """Return a dictionary {tile number: func(tile, **kwargs)}.
+
+    Parameter 'func' is applied to every tile of 'data' in a separate
+    process, and must be a module-level function so that it can be sent
+    there; the tiles it is given are read-only.  Parameter 'workers' is
+    the number of processes, by default one per core.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    numbers = [int(tnum) for tnum in data.tile_index()[0]]
+    fd, path = tempfile.mkstemp(suffix='.scan')
+    os.close(fd)
+    try:
+        data.save(path, {})
+        pool = ProcessPoolExecutor(workers)
+        try:
+            results = list(pool.map(run_tile, [path]*len(numbers),
+                                    [func]*len(numbers), numbers,
+                                    [kwargs]*len(numbers)))
+        finally:
+            pool.shutdown()
+    finally:
+        os.remove(path)
+    return dict(zip(numbers, results))
+
+#Functions applied to single tiles
+def tile_deviations(tile, numpoints=10):
+    from lsst.analysis import neighbors, outlier
+    return outlier.deviations(tile, neighbors.NeighborIndex(tile.points),
+                              numpoints)
+
+def tile_plane(tile): return tile.plane()
+
+def tile_spline(tile, smoothing=None): return tile.spline(smoothing)
+
+def tile_sums(tile, origin=(0, 0)):
+    from lsst.analysis import utils
+    return utils.PlaneSums(origin).add(tile.points, tile.z)
+
+def remove_outliers(data, std_tol=1.5, workers=None):
+    """Remove the most extreme points of 'data', as remove_outliers does."""
+    dev = numpy.zeros(len(data))
+    for tnum, tdev in map_tiles(data, tile_deviations, workers).items():
+        dev[data.tile_members(tnum)] = tdev
+    data.decimate((dev < std_tol * numpy.std(data.z)).reshape(data.shape))
+
+def planes(data, workers=None):
+    """Return the best-fit plane of each tile, by tile number."""
+    return map_tiles(data, tile_plane, workers)
+
+def planarize(data, workers=None):
+    """Subtract from each tile of 'data' its best-fit plane.
+
+    Returns the planes, by tile number.
+    """
+    from lsst.analysis import utils
+    assert numpy.isfinite(data.z).all()
+    fits = planes(data, workers)
+    xy, z = data.points.reshape((-1, 2)), numpy.array(data.z).reshape(-1)
+    for tnum in fits:
+        members = data.tile_members(tnum)
+        z[members] -= utils.evalplane(fits[tnum], xy[members])
+    data.z = z.reshape(data.shape)
+    return fits
+
+def splines(data, smoothing=None, workers=None):
+    """Return the best-fit spline of each tile, by tile number."""
+    return map_tiles(data, tile_spline, workers, smoothing=smoothing)
+
+def plane_sums(data, origin=(0, 0), workers=None):
+    """Return a utils.PlaneSums of each tile, by tile number.
+
+    Their sum is the plane fit of the whole data.
+    """
+    return map_tiles(data, tile_sums, workers, origin=origin)
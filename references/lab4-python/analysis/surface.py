@@ -0,0 +1,208 @@
+"""Surface fitting for scans of any size.
+
+bisplrep chooses its own knots over the whole data set at once, which is
+fine for a few thousand points but runs out of memory or time on a full
+raft.  The fitters here all return something evalspline (see utils.py)
+accepts:
+
+- grid: a smoothing spline of a raster grid (RectBivariateSpline), as a
+  tuple (t, c, k) like bisplrep returns;
+- lsq: a least-squares spline on user-chosen knots (LSQBivariateSpline),
+  also as a tuple (t, c, k);
+- Tiled: least-squares splines on overlapping cells of the data, blended
+  linearly across the overlaps, for large scattered data.
+
+fit() picks one of these, and benchmark() measures them.
+
+Classes:
+Tiled -- A surface made of blended least-squares splines.
+
+Functions:
+fit -- Fit a surface with the method best suited to the data.
+grid -- Fit a smoothing spline to a raster grid.
+monotonic -- Whether an axis is strictly increasing or decreasing.
+lsq -- Fit a least-squares spline with given knots.
+benchmark -- Time and memory of the fitters for growing numbers of points.
+"""
+
+import time
+import numpy
+from scipy.interpolate import (bisplrep, LSQBivariateSpline,
+                               RectBivariateSpline)
+
+def as_tck(spline):
+    return list(spline.tck) + list(spline.degrees)
+
+def grid(x, y, z, smoothing=None, k=3):
+    """Fit a spline to values z of shape (len(y), len(x)) on a grid.
+
+    Parameters 'x' and 'y' are the grid axes, as in raster_data; each
+    must be strictly increasing or strictly decreasing.  The default
+    smoothing is that of bisplrep, m-sqrt(2*m).
+    """
+    x, y, z = numpy.asarray(x), numpy.asarray(y), numpy.asarray(z)
+    if x[-1] < x[0]: x, z = x[::-1], z[:,::-1]
+    if y[-1] < y[0]: y, z = y[::-1], z[::-1]
+    m = numpy.size(z)
+    s = m - numpy.sqrt(2*m) if smoothing is None else smoothing
+    return as_tck(RectBivariateSpline(x, y, numpy.transpose(z), kx=k, ky=k,
+                                      s=s))
+
+def lsq(xy, z, knots=8, k=3, bbox=None):
+    """Fit a least-squares spline to scattered points.
+
+    Parameter 'knots' is the number of evenly spaced interior knots on
+    each axis, or a pair of arrays of interior knots (tx, ty).  Parameter
+    'bbox' is the (xmin, xmax, ymin, ymax) of the spline, by default that
+    of the points.  Points that are not finite are ignored.
+    """
+    xy, z = xy.reshape((-1, 2)), numpy.ravel(z)
+    good = numpy.isfinite(z) & numpy.isfinite(xy).all(axis=1)
+    xy, z = xy[good], z[good]
+    if bbox is None:
+        bbox = (xy[:,0].min(), xy[:,0].max(), xy[:,1].min(), xy[:,1].max())
+    if numpy.ndim(knots) == 0:
+        knots = [numpy.linspace(lo, hi, knots + 2)[1:-1]
+                 for lo, hi in (bbox[:2], bbox[2:])]
+    return as_tck(LSQBivariateSpline(xy[:,0], xy[:,1], z, knots[0], knots[1],
+                                     kx=k, ky=k, bbox=list(bbox)))
+
+class Tiled:
+    def __init__(self, xy, z, cells=None, overlap=.25, knots=6, k=3,
+                 cellpoints=20000):
+        """Fit least-squares splines to overlapping cells of the points.
+
+        The bounding box of the points is divided into cells[0] by
+        cells[1] cells (by default about 'cellpoints' points each), and
+        each cell, widened by 'overlap' of its size on every side (but not
+        beyond the points), gets its own lsq() spline with 'knots' and 'k'.
+        Parameter 'overlap' must be more than 0 and at most 0.5.  A cell
+        with too few points for its spline is left out.
+        """
+        assert 0 < overlap <= .5
+        xy, z = xy.reshape((-1, 2)), numpy.ravel(z)
+        good = numpy.isfinite(z) & numpy.isfinite(xy).all(axis=1)
+        xy, z = xy[good], z[good]
+        if cells is None:
+            cells = max(1, int(numpy.ceil(numpy.sqrt(len(z)/cellpoints))))
+        self.cells = numpy.broadcast_to(cells, (2,)).astype('int')
+        self.lo, self.hi = xy.min(axis=0), xy.max(axis=0)
+        self.width = (self.hi - self.lo) / self.cells
+        self.margin = overlap * self.width
+        self.splines = {}
+        need = (knots + k + 1)**2
+        for i in range(self.cells[0]):
+            for j in range(self.cells[1]):
+                lo, hi = self.bounds(i, j)
+                lo = numpy.maximum(lo, self.lo)
+                hi = numpy.minimum(hi, self.hi)
+                inside = ((xy >= lo) & (xy <= hi)).all(axis=1)
+                if inside.sum() >= need:
+                    self.splines[i, j] = lsq(xy[inside], z[inside], knots, k,
+                                             (lo[0], hi[0], lo[1], hi[1]))
+
+    def bounds(self, i, j):
+        """Return the corners of cell (i, j), widened by the overlap."""
+        lo = self.lo + self.width * (i, j) - self.margin
+        return lo, lo + self.width + 2*self.margin
+
+    def weights(self, xy, i, j):
+        #Ramps from 0 to 1 across each overlap, so that the weights of
+        #neighboring cells add up to 1; flat beyond the edges of the data.
+        lo, hi = self.bounds(i, j)
+        lo = numpy.where(numpy.equal((i, j), 0), -numpy.inf, lo)
+        hi = numpy.where(numpy.equal((i, j), self.cells - 1), numpy.inf, hi)
+        ramp = numpy.minimum(xy - lo, hi - xy) / (2*self.margin)
+        return numpy.prod(numpy.clip(ramp, 0, 1), axis=1)
+
+    def __call__(self, xy):
+        """Evaluate the surface at an array of points xy."""
+        from lsst.analysis import utils
+        xy = numpy.asarray(xy, dtype='float')
+        pts = xy.reshape((-1, 2))
+        total, weight = numpy.zeros(len(pts)), numpy.zeros(len(pts))
+        for (i, j), spline in self.splines.items():
+            w = self.weights(pts, i, j)
+            near = numpy.flatnonzero(w > 0)
+            total[near] += w[near] * utils.evalpoints(spline, pts[near])
+            weight[near] += w[near]
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            return (total / weight).reshape(xy.shape[:-1])
+
+def monotonic(axis):
+    """Whether a 1-d array is strictly increasing or strictly decreasing."""
+    steps = numpy.diff(axis)
+    return (steps > 0).all() or (steps < 0).all()
+
+def fit(xy, z, smoothing=None, method='auto', **kwargs):
+    """Fit a surface to z at the points xy.
+
+    Parameter 'method' is one of 'bisplrep', 'grid', 'lsq', 'tiled' or
+    'auto', which uses grid() for a complete raster grid with monotonic
+    axes, bisplrep for up to 2000 other points and Tiled beyond.  Other
+    keyword arguments are passed to the fitter.
+
+    Only 'bisplrep' and 'grid' take a 'smoothing'; the knots of 'lsq' and
+    'tiled' set their smoothness instead, and giving them a smoothing
+    raises ValueError.  So 'auto' keeps to bisplrep at any size when a
+    smoothing is given.
+    """
+    from lsst.analysis import utils
+    xy = numpy.asarray(xy, dtype='float')
+    gridded = (xy.ndim == 3 and utils.isgrid(xy) and
+               monotonic(xy[0,:,0]) and monotonic(xy[:,0,1]) and
+               numpy.isfinite(z).all())
+    if method == 'auto':
+        method = ('grid' if gridded else
+                  'bisplrep' if numpy.size(z) <= 2000 or smoothing is not None
+                  else 'tiled')
+    if smoothing is not None and method in ('lsq', 'tiled'):
+        raise ValueError("method '{0}' takes no smoothing".format(method))
+    if method == 'grid':
+        assert gridded
+        return grid(xy[0,:,0], xy[:,0,1], z, smoothing, **kwargs)
+    elif method == 'lsq':
+        return lsq(xy, z, **kwargs)
+    elif method == 'tiled':
+        return Tiled(xy, z, **kwargs)
+    return bisplrep(xy[...,0].ravel(), xy[...,1].ravel(), numpy.ravel(z),
+                    s=smoothing, **kwargs)
+
+def benchmark(sizes=(10**4, 10**5, 10**6), seed=0):
+    """Fit a test surface with increasing numbers of points.
+
+    Returns a list of (points, method, seconds, peak MB, rms error in um).
+    Memory is only measured where the tracemalloc module exists.
+    """
+    from lsst.analysis import utils
+    try: import tracemalloc
+    except ImportError: tracemalloc = None
+    random, result = numpy.random.RandomState(seed), []
+    def surface(xy):
+        return 5*numpy.sin(xy[...,0]/7.) * numpy.cos(xy[...,1]/11.)
+    for n in sizes:
+        side = int(numpy.sqrt(n))
+        axis = numpy.linspace(0, 100, side)
+        gridded = numpy.dstack(numpy.meshgrid(axis, axis))
+        scattered = random.uniform(0, 100, (n, 2))
+        for method, xy in (('grid', gridded), ('lsq', scattered),
+                           ('tiled', scattered)):
+            z = surface(xy) + random.normal(0, .1, xy.shape[:-1])
+            if tracemalloc: tracemalloc.start()
+            start = time.time()
+            spline = fit(xy, z, len(z.flat)*.01 if method == 'grid' else None,
+                         method)
+            seconds = time.time() - start
+            peak = tracemalloc.get_traced_memory()[1]/1e6 if tracemalloc \
+                else numpy.nan
+            if tracemalloc: tracemalloc.stop()
+            test = random.uniform(10, 90, (1000, 2))
+            error = numpy.std(utils.evalspline(spline, test) - surface(test))
+            result.append((n, method, seconds, peak, error))
+    return result
+
+if __name__ == '__main__':
+    print('{0:>8} {1:>6} {2:>8} {3:>8} {4:>8}'
+          .format('points', 'method', 'seconds', 'MB', 'rms'))
+    for row in benchmark():
+        print('{0:>8} {1:>6} {2:8.2f} {3:8.1f} {4:8.4f}'.format(*row))
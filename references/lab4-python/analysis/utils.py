@@ -1,5 +1,6 @@
+from collections import OrderedDict
 import numpy
-from scipy.interpolate import bisplrep, bisplev
+from scipy.interpolate import bisplev
 
 def fitplane(xy, z):
     """
@@ -8,10 +9,92 @@ def fitplane(xy, z):
     xy is an array of shape (m, 2).
     z is an array of shape (m,).
     The return value is a tuple (a, b, c) satisfying z=a*xy[:,0]+b*xy[:,1]+c.
+    Points where z is not finite are ignored.  The plane is fitted from the
+    sums of a PlaneSums, except when the points do not determine it (fewer
+    than three, or collinear): lstsq then gives its minimum-norm plane,
+    which depends on where the origin is.
     """
-    pts = xy.reshape((-1, 2))
-    return numpy.linalg.lstsq(numpy.column_stack([pts, numpy.ones(len(pts))]),
-                                                 z.ravel())[0]
+    pts = numpy.reshape(xy, (-1, 2))
+    sums = PlaneSums(pts.mean(axis=0) if len(pts) else (0, 0)).add(pts, z)
+    if numpy.linalg.matrix_rank(sums.sums[:3,:3]) == 3: return sums.plane()
+    z = numpy.ravel(z)
+    good = numpy.isfinite(z)
+    return numpy.linalg.lstsq(numpy.column_stack([pts[good],
+                              numpy.ones(good.sum())]), z[good])[0]
+
+class PlaneSums:
+    def __init__(self, origin=(0, 0)):
+        """
+        Create an empty, incremental least-squares plane fit.
+        
+        Only the sums of the normal equations of z=a*x+b*y+c are kept, so
+        points can be added, removed again (such as outliers) and fits of
+        separate tiles or processes merged, at a cost independent of the
+        number of points so far.  x and y are taken relative to 'origin',
+        which should lie among the points for the sums to stay accurate.
+        """
+        self.origin = numpy.array(origin, dtype='float')
+        self.sums = numpy.zeros((4, 4)) #sums of v*v.T, for v = (x, y, 1, z)
+        self.low, self.high = numpy.inf, -numpy.inf
+    
+    def add(self, xy, z, sign=1):
+        """
+        Add the points xy, of shape (..., 2), with values z to the fit.
+        
+        Points where z is not finite are ignored.  Returns this object.
+        """
+        xy = numpy.asarray(xy, dtype='float').reshape((-1, 2)) - self.origin
+        z = numpy.ravel(z)
+        good = numpy.isfinite(z)
+        v = numpy.column_stack([xy[good], numpy.ones(good.sum()), z[good]])
+        self.sums += sign * v.T.dot(v)
+        if sign > 0 and len(v) and self.count() >= 3:
+            res = v[:,3] - v[:,:3].dot(self.coef())
+            self.low = min(self.low, res.min())
+            self.high = max(self.high, res.max())
+        return self
+    
+    def remove(self, xy, z):
+        """Remove points that were added before from the fit."""
+        return self.add(xy, z, -1)
+    
+    def __add__(self, other):
+        assert (self.origin == other.origin).all()
+        result = PlaneSums(self.origin)
+        result.sums = self.sums + other.sums
+        result.low = min(self.low, other.low)
+        result.high = max(self.high, other.high)
+        return result
+    
+    def count(self): return int(round(self.sums[2,2]))
+    
+    def coef(self):
+        return numpy.linalg.lstsq(self.sums[:3,:3], self.sums[:3,3])[0]
+    
+    def plane(self):
+        """Return the best fit plane (a, b, c), as fitplane does."""
+        a, b, c = self.coef()
+        return numpy.array([a, b, c - a*self.origin[0] - b*self.origin[1]])
+    
+    def rms(self):
+        """Return the RMS distance of the points from the plane."""
+        if not self.count(): return numpy.nan
+        sq = self.sums[3,3] - self.coef().dot(self.sums[:3,3])
+        return numpy.sqrt(max(sq, 0) / self.count())
+    
+    def stats(self):
+        """
+        Return a dictionary of flatness statistics.
+        
+        'tip' and 'tilt' are the slopes of the plane along x and y, and
+        'piston' its height at the origin.  'ptv' is the peak-to-valley of
+        the points around the plane as it was fitted when they were added,
+        and is not narrowed by remove().
+        """
+        tip, tilt, piston = self.coef()
+        return {'points': self.count(), 'tip': tip, 'tilt': tilt,
+                'piston': piston, 'rms': self.rms(),
+                'ptv': max(self.high - self.low, 0)}
 
 def evalplane(abc, xy):
     """
@@ -21,14 +104,113 @@ def evalplane(abc, xy):
     xy = numpy.array(xy) #Allows us to use fancy slicing even if xy is a list
     return abc[0]*xy[...,0] + abc[1]*xy[...,1] + abc[2]
 
-def fitspline(xy, z, smoothing=None):
+def fitlinear(x, z):
+    """
+    Calculate the least-squares fit of z to the columns of x and a constant.
+    
+    x is an array of shape (m, k).
+    z is an array of shape (m,).
+    Points where z or any column of x is not finite are ignored.
+    The return value is an array (a_1, ..., a_k, c) satisfying
+    z=a_1*x[:,0]+...+a_k*x[:,k-1]+c.
+    """
+    good = numpy.isfinite(z) & numpy.isfinite(x).all(axis=1)
+    return numpy.linalg.lstsq(numpy.column_stack([x[good],
+                                                  numpy.ones(good.sum())]),
+                              z[good])[0]
+
+def fitspline(xy, z, smoothing=None, method='auto', **kwargs):
     """
     Return a tuple (t, c, k) describing the spline as described in the
-    Numpy documentation.
+    Numpy documentation, or for large scattered data without a smoothing
+    a surface.Tiled.  Either can be passed to evalspline.  See surface.fit
+    for the methods.
+    """
+    from lsst.analysis import surface
+    return surface.fit(xy, z, smoothing, method, **kwargs)
+
+def basis(t, k, x):
     """
-    return bisplrep(xy[...,0].ravel(), xy[...,1].ravel(), z.ravel(),
-                    s=smoothing)
+    Evaluate the B-splines of degree k with knots t at the points x.
+    
+    Only k+1 B-splines are nonzero at any point.  The return value is a
+    tuple (i, b): B-spline i+r has the value b[:,r] at x.  Points outside
+    the knots are moved to the nearest end, as bisplev does.
+    """
+    t = numpy.asarray(t, dtype='float')
+    x = numpy.clip(x, t[k], t[len(t)-k-1])
+    m = numpy.clip(numpy.searchsorted(t, x, 'right') - 1, k, len(t)-k-2)
+    b = numpy.zeros((len(x), k+1))
+    b[:,0] = 1
+    for j in range(1, k+1): #Cox-de Boor recursion, for all points at once
+        saved = numpy.zeros(len(x))
+        for r in range(j):
+            left, right = x - t[m+1-j+r], t[m+1+r] - x
+            temp = b[:,r] / (left + right)
+            b[:,r] = saved + right*temp
+            saved = left*temp
+        b[:,j] = saved
+    return m - k, b
+
+def evalpoints(spline, xy, chunk=65536):
+    """
+    Evaluate the spline (t, c, k) at an array of scattered points xy.
+    """
+    tx, ty, c, kx, ky = spline
+    c, pts = numpy.asarray(c), xy.reshape((-1, 2))
+    ny, z = len(ty) - ky - 1, numpy.empty(len(pts))
+    for n in range(0, len(pts), chunk):
+        i, bx = basis(tx, kx, pts[n:n+chunk,0])
+        j, by = basis(ty, ky, pts[n:n+chunk,1])
+        coef = c[(i[:,None,None] + numpy.arange(kx+1)[:,None]) * ny +
+                 j[:,None,None] + numpy.arange(ky+1)]
+        z[n:n+chunk] = numpy.einsum('ni,nj,nij->n', bx, by, coef)
+    return z.reshape(xy.shape[:-1])
+
+def isgrid(xy):
+    """
+    Whether an array of shape (m, n, 2) is a grid like those of raster_data,
+    with x constant down each column and y constant along each row.
+    """
+    return ((xy[...,0] == xy[:1,:,0]).all() and
+            (xy[...,1] == xy[:,:1,1]).all())
+
+surfaces = OrderedDict() # cache of evaluated grids, see evalgrid
+cachesize = 16
+
+def evalgrid(spline, x, y):
+    """
+    Evaluate the spline (t, c, k) on the grid of the axes x and y.
+    
+    The result has shape (len(y), len(x)).  bisplev is called once, and
+    the surface is cached: evaluating the same spline on the same grid
+    again returns a copy of the cached surface.
+    """
+    tx, ty, c, kx, ky = spline
+    key = tuple(numpy.asarray(arr, dtype='float').tobytes()
+                for arr in (tx, ty, c, x, y)) + (kx, ky)
+    if key in surfaces:
+        surfaces[key] = surfaces.pop(key) #Most recently used goes last
+    else:
+        ux, ix = numpy.unique(x, return_inverse=True)
+        uy, iy = numpy.unique(y, return_inverse=True)
+        z = numpy.reshape(bisplev(ux, uy, spline), (len(ux), len(uy)))
+        surfaces[key] = z[ix][:,iy].T
+        if len(surfaces) > cachesize: surfaces.popitem(last=False)
+    return surfaces[key].copy()
 
 def evalspline(spline, xy):
-    return numpy.apply_along_axis(lambda pt: bisplev(pt[0], pt[1], spline),
-                                  len(xy.shape) - 1, xy)
+    """
+    Evaluate the spline (t, c, k) at a point or array of points xy.
+    
+    Grids of points, in either axis order, are evaluated by evalgrid, and
+    any other points by evalpoints.  Surfaces that are not splines, such as
+    a surface.Tiled, are simply called.
+    """
+    xy = numpy.asarray(xy, dtype='float')
+    if callable(spline): return spline(xy)
+    if xy.ndim == 3 and isgrid(xy):
+        return evalgrid(spline, xy[0,:,0], xy[:,0,1])
+    if xy.ndim == 3 and isgrid(xy.swapaxes(0, 1)):
+        return evalgrid(spline, xy[:,0,0], xy[0,:,1]).T
+    return evalpoints(spline, xy)
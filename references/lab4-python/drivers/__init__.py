@@ -1 +1,2 @@
-__all__ = ["a3200", "netbotz", "keyence", "temppoint"]
+__all__ = ["a3200", "fakeport", "netbotz", "keyence", "simulator",
+           "telemetry", "temppoint"]
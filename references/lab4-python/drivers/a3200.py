@@ -6,19 +6,37 @@ A3200Exception -- Raised when an A3200 DLL call returns an error.
 
 Properties:
 x, y, z -- The three axes of the gantry.
-cmplr, sys -- Objects representing the two Aerotech DLL files.
+cmplr, sys -- Objects representing the two Aerotech DLL files, or the
+    simulated ones of simulator.py if the environment variable
+    LSST_SIMULATE is set.
 haerctrl -- A handle representing the current connection to the gantry.
+functions -- The DLL functions used so far, resolved and prototyped once.
 
 Functions:
 mask -- Return the axis mask for a list of axes.
+function -- Return a DLL function from the call table.
 rawdllfunc -- Execute the specified function from a given DLL file.
 dllfunc -- Execute a function from the "sys" DLL and pass it "haerctrl".
 dllmove -- Execute a multi-axis move command from the "sys" DLL file.
 wait -- Wait for all actions on the given list of axes to complete.
+positions -- Read the positions of several axes in one DLL call.
 xy*** -- Convenience functions that operate on x and y simultaneously.
 """
 
 import ctypes
+import os
+
+#Argument types of the functions called for every point; the others are
+#left to the default conversions of ctypes.
+prototypes = {
+    'MoveAbsolute': [ctypes.c_int]*4,
+    'MoveIncremental': [ctypes.c_int]*4,
+    'MoveWaitDone': [ctypes.c_int]*4,
+    'MoveMWaitDone': [ctypes.c_int]*4,
+    'StatusGetAxisInfoPosition': [ctypes.c_int]*3 +
+        [ctypes.POINTER(ctypes.c_double)] + [ctypes.c_void_p]*8}
+functions = {}
+nulls = (ctypes.c_void_p(),)*8
 
 def initialized():
     temp = ctypes.c_int()
@@ -47,6 +65,20 @@ def mask(axes):
     """
     return sum([axis.mask for axis in axes])
 
+def function(dll, name):
+    """Return the function "Aer"+name of a DLL library.
+    
+    The function is looked up, and given its prototype if it has one,
+    only the first time it is asked for.
+    """
+    if (dll, name) not in functions:
+        func = getattr(dll, "Aer"+str(name))
+        if hasattr(func, 'argtypes'):
+            func.restype = ctypes.c_int
+            if name in prototypes: func.argtypes = prototypes[name]
+        functions[dll, name] = func
+    return functions[dll, name]
+
 def rawdllfunc(dll, name, *params):
     """Execute a function from a DLL library and catch errors accordingly.
     
@@ -57,7 +89,7 @@ def rawdllfunc(dll, name, *params):
     
     The function name is automatically prefixed with "Aer".
     """
-    result = getattr(dll, "Aer"+str(name))(*params)
+    result = function(dll, name)(*params)
     if result != 0 and name != "ErrGetMessageEx": #Prevent infinite recursion
         raise A3200Exception(result)
 
@@ -82,6 +114,22 @@ def wait(axes, timeout=0):
     """
     dllfunc("MoveMWaitDone", mask(axes), timeout*100, 0)
 
+def positions(axes):
+    """Return the positions of the specified axes in mm, in one DLL call.
+    
+    Parameters:
+    axes -- A list of axis objects.
+    
+    The DLL returns one position per axis in the mask, in axis order.
+    """
+    order = sorted(range(len(axes)), key=lambda n: axes[n].index)
+    dllfunc("StatusGetAxisInfoPosition", mask(axes), 0, position_buffer,
+            *nulls)
+    result = [None]*len(axes)
+    for slot, n in enumerate(order):
+        result[n] = position_buffer[slot]/axes[n].steps
+    return result
+
 def faultack():
     dllfunc("SysFaultAck", mask([x, y, z]), 0, True)
 
@@ -103,7 +151,7 @@ def xyrelmove(destination, velocity=100, blocking=True):
     if blocking: wait([x, y])
 
 def xyposition():
-    return x.position(), y.position()
+    return tuple(positions([x, y]))
 
 def xyhome(blocking=True):
     x.home(blocking=False)
@@ -116,6 +164,7 @@ class Axis:
     Instance variables:
     index -- The index of this axis (starting from 0).
     mask -- The axis mask for this axis only.
+    buffer -- The ctypes array its position is read into.
     
     Methods:
     dist -- Convert a measurement from microns to machine steps.
@@ -138,6 +187,7 @@ class Axis:
         self.index = index
         self.mask = 2**self.index
         self.steps = steps_per_mm
+        self.buffer = (ctypes.c_double * 1)()
     
     def dist(self, mm):
         """Convert a measurement from mm to machine steps."""
@@ -161,12 +211,9 @@ class Axis:
     
     def position(self):
         """Get the current position of this axis in mm."""
-        temp = ctypes.c_double()
-        dllfunc("StatusGetAxisInfoPosition", self.mask, 0,
-            ctypes.pointer(temp), *[ctypes.c_void_p()]*8)
-        position = temp.value/self.steps
-        del temp
-        return position
+        dllfunc("StatusGetAxisInfoPosition", self.mask, 0, self.buffer,
+                *nulls)
+        return self.buffer[0]/self.steps
     
     def wait(self, timeout=0):
         """Wait for all actions on this axis to complete.
@@ -245,6 +292,11 @@ class A3200Exception(Exception):
     def __str__(self):
         return self.errormsg
 
-cmplr, sys = ctypes.windll.A32CMPLR, ctypes.windll.A32SYS
+if os.environ.get('LSST_SIMULATE'):
+    from lsst.drivers import simulator
+    cmplr = sys = simulator.dll
+else:
+    cmplr, sys = ctypes.windll.A32CMPLR, ctypes.windll.A32SYS
 haerctrl = ctypes.c_int()
+position_buffer = (ctypes.c_double * 32)()
 x, y, z = Axis(0), Axis(1), Axis(2, 2)
@@ -0,0 +1,81 @@
+"""Loopback stand-in for a serial port, answering like a Keyence LT-9501.
+
+Classes:
+FakePort -- Object with the parts of the serial.Serial interface in use.
+
+Functions:
+keyence_reply -- Default responder, answering a few Keyence commands.
+benchmark -- Measure keyence commands per second over a FakePort.
+
+Usage:
+  from lsst.drivers import keyence, fakeport
+  keyence.link = keyence.Link(fakeport.FakePort())
+"""
+
+import time
+
+def keyence_reply(command):
+    """Return the reply (without carriage return) to a list of fields."""
+    if command[0] in ['M0', 'M1', 'M2']:
+        return ','.join([command[0]] + ['+0012.3456']*(1 + (command[0]=='M0')))
+    elif command[:2] == ['SR', 'OA']: return 'SR,OA,' + command[2] + ',4'
+    elif command[:2] == ['SR', 'SC']: return 'SR,SC,1'
+    elif command[0] == 'SD': return ','.join(command[:2])
+    else: return 'ER,' + command[0] + ',00'
+
+class FakePort:
+    def __init__(self, respond=keyence_reply, chunk=None):
+        """Create a port that answers every command with respond(fields).
+        
+        Parameter 'chunk' limits the number of bytes returned by one read,
+        to exercise code that has to reassemble fragmented replies.
+        """
+        self.respond, self.chunk = respond, chunk
+        self.written, self.replies, self.is_open = '', [], False
+        self.waiting, self.pos = '', 0
+    
+    def open(self): self.is_open = True
+    def close(self): self.is_open = False
+    
+    def inWaiting(self):
+        if self.replies:
+            self.waiting = self.waiting[self.pos:] + ''.join(self.replies)
+            self.replies, self.pos = [], 0
+        return len(self.waiting) - self.pos
+    
+    def write(self, data):
+        self.written += data
+        while "\r" in self.written:
+            command, self.written = self.written.split("\r", 1)
+            self.replies.append(self.respond(command.split(',')) + "\r")
+    
+    def read(self, size=1):
+        size = min(size, self.chunk or size, self.inWaiting())
+        data = self.waiting[self.pos:self.pos+size]
+        self.pos += size
+        return data
+
+def benchmark(n=10000, chunk=None):
+    """Print and return the keyence commands per second over a FakePort.
+    
+    Measures single measure() calls, and the same commands sent in one
+    batch with raw_commands().
+    """
+    from lsst.drivers import keyence
+    saved, keyence.link = keyence.link, keyence.Link(FakePort(chunk=chunk))
+    try:
+        start = time.time()
+        for i in range(n): keyence.measure()
+        single = n / (time.time() - start)
+        start = time.time()
+        keyence.raw_commands([['M1', '0']]*n)
+        batched = n / (time.time() - start)
+    finally:
+        keyence.link = saved
+    print('{0:.0f} commands/s one at a time, {1:.0f} commands/s batched'
+          .format(single, batched))
+    return single, batched
+
+if __name__ == '__main__':
+    benchmark()
+    benchmark(chunk=1)
@@ -1,22 +1,86 @@
 """Wrapper module for the Keyence LT-9501, connected via the serial port.
 
 Properties:
-port -- Serial port object that is connected to the sensor.
+port -- Serial port object that is connected to the sensor, or a
+    simulated sensor (see simulator.py) if LSST_SIMULATE is set.
+link -- Framing layer that sends commands and splits replies on 'port'.
+config -- Cached sensor settings, kept up to date by the set_* functions.
+delay -- Seconds from the moment a reading describes to the middle of the
+    measure() call that returns it.
+counters -- Number of serial round trips made since the module was loaded.
+
+Classes:
+Link -- Buffered, framed command/reply channel over a serial port.
 
 Functions:
 raw_command -- Send a specified string to the sensor.
+raw_commands -- Send several commands at once and collect all replies.
 set_samples -- Set the number of samples to be averaged.
 measure -- Return the value reported by the sensor.
 """
 
-import serial
+import collections
+import os
 import time
 
-port = serial.Serial(baudrate=115200)
-port.port = 0
+if os.environ.get('LSST_SIMULATE'):
+    from lsst.drivers import simulator
+    port = simulator.sensor
+else:
+    import serial
+    port = serial.Serial(baudrate=115200)
+    port.port = 0
+
+#The sensor settings last read or written.  Entries are ('samples', out),
+#'scan_mode' and 'time' (the integration time derived from the other two).
+config = {}
+counters = {'round_trips': 0}
+
+#The sensor answers as soon as a command arrives, so a reading describes
+#the moment half an 'M1' round trip before the middle of measure().  The
+#time the sensor takes to process the command is not included.
+delay = 10. * len('M1,0\rM1,+0000.0000\r') / 115200 / 2
+
+class Link:
+    """Send commands over a serial port and split the replies into frames.
+    
+    Replies are read in chunks of whatever bytes are waiting, instead of
+    one byte at a time, and split on carriage returns.  Several commands
+    may be outstanding at once; their replies are returned in order.
+    """
+    
+    def __init__(self, port):
+        self.port = port
+        self.reset()
+    
+    def reset(self):
+        """Forget any partial or unread replies."""
+        self.buffer, self.replies = '', collections.deque()
+    
+    def send(self, command):
+        """Send one command, given as a list of fields."""
+        counters['round_trips'] += 1
+        self.port.write(','.join(command) + "\r")
+    
+    def receive(self):
+        """Return the next reply, without the carriage return.
+        
+        Returns None if the port times out before a full reply arrives.
+        """
+        while not self.replies:
+            chunk = self.port.read(self.port.inWaiting() or 1)
+            if not chunk: return None
+            frames = (self.buffer + chunk).split("\r")
+            self.buffer = frames.pop()
+            self.replies.extend(frames)
+        return self.replies.popleft()
+
+link = Link(port)
 
 def open():
     port.open()
+    link.reset()
+    config.clear()
 
 def raw_command(command):
     """Send a command to the sensor over the serial port.
@@ -30,10 +94,24 @@ def raw_command(command):
     Returns a list.  If the data received back is 'SD,OA\r', the return
     value is ['SD', 'OA'].
     """
-    port.write(','.join(command) + "\r")
-    chars = [port.read()]
-    while chars[-1] != "\r": chars.append(port.read())
-    result = ''.join(chars[:-1]).split(',')
+    link.send(command)
+    return parse(link.receive(), command)
+
+def raw_commands(commands):
+    """Send a list of commands back to back and return the list of replies.
+    
+    All commands are written before any reply is read, so the serial
+    latency is paid once rather than once per command.
+    """
+    for command in commands: link.send(command)
+    replies = [link.receive() for command in commands]
+    return [parse(reply, command)
+            for reply, command in zip(replies, commands)]
+
+def parse(reply, command):
+    """Split a reply into fields, raising KeyenceException on errors."""
+    if reply is None: raise KeyenceException('88', command)
+    result = reply.split(',')
     if result[0] != 'ER': return result
     else: raise KeyenceException(result[2], command)
 
@@ -70,13 +148,17 @@ def get_scan_mode():
     """Get the scan mode.  See the manual for more information.
     
     Returns a tuple (width, pitch)."""
-    return scan_modes[intcode(raw_command(['SR', 'SC'])[2])]
+    config['scan_mode'] = scan_modes[intcode(raw_command(['SR', 'SC'])[2])]
+    config.pop('time', None)
+    return config['scan_mode']
 
 def set_scan_mode(mode):
     """Set the scan mode.  See the manual for more information.
     
     'mode' is a tuple (width, pitch)."""
     raw_command(['SD','SC', hexcode(scan_modes.index(mode))])
+    config['scan_mode'] = mode
+    config.pop('time', None)
 
 def get_samples(out=1):
     """Get the number of samples to be averaged.
@@ -84,7 +166,10 @@ def get_samples(out=1):
     Parameters:
     out -- 1 for output channel 1, 2 for output channel 2, 0 for both.
     """
-    return intcode(raw_command(['SR', 'OA', str(out)])[3])
+    samples = intcode(raw_command(['SR', 'OA', str(out)])[3])
+    if out: config['samples', out] = samples
+    config.pop('time', None)
+    return samples
     
 def set_samples(num_samples, out=1):
     """Set the number of samples to be averaged.
@@ -94,15 +179,24 @@ def set_samples(num_samples, out=1):
     out -- 1 for output channel 1, 2 for output channel 2, 0 for both.
     """
     raw_command(['SD', 'OA', str(out), hexcode(num_samples)])
+    for o in ([1, 2] if out == 0 else [out]):
+        config['samples', o] = num_samples
+    config.pop('time', None)
 
 def get_time():
     """Calculate the time required to take a measurement, in seconds.
     
     See pages 7-14 and 9-6 in the Keyence manual for more information.
+    The settings are only read from the sensor if they are not cached.
     """
-    s = get_samples()
-    return 1.3 * (scan_times[get_scan_mode()]*
-                  (2**s+2**(s-6 if s>6 else 0))+0.64)/1000
+    if 'time' not in config:
+        s = config['samples', 1] if ('samples', 1) in config \
+            else get_samples()
+        mode = config['scan_mode'] if 'scan_mode' in config \
+            else get_scan_mode()
+        config['time'] = 1.3 * (scan_times[mode]*
+                                (2**s+2**(s-6 if s>6 else 0))+0.64)/1000
+    return config['time']
 
 def measure(out=1, blocking=False):
     """Return the currently measured value from the sensor.
@@ -23,7 +23,7 @@ community = "bnlio"
 def raw_get(oid):
     command = '"'+path+'" -c '+community+' -v 2c '+host+' '+oid
     query = subprocess.Popen(command, stdout=subprocess.PIPE)
-    query.wait()
+    #communicate() reads until exit; calling wait() first can deadlock
     return float(query.communicate()[0].split('"')[1]) #Extract the number
 
 def temperature():
@@ -0,0 +1,572 @@
+"""Simulated gantry and sensor, to run scans without the hardware.
+
+If the environment variable LSST_SIMULATE is set (to anything but an empty
+string) when the drivers are imported, drivers/a3200.py calls the DLL
+functions simulated here instead of the Aerotech ones, and
+drivers/keyence.py talks to a simulated serial port instead of the real
+one.  Everything above the drivers - scans, sweeps, pipelines, sphere
+finding and utils/scanner.py - then runs unchanged on any machine, in real
+time:
+
+- every axis moves with a trapezoidal velocity profile (limited by its
+  acceleration) and then settles for a fixed time before it is done;
+- the sensor reads the height of a synthetic Surface under the current
+  stage position, with noise averaged down by the number of samples, a
+  slow drift, and dark regions where it has no reading; keyence.measure
+  already waits out the integration time given by keyence.scan_times;
+- every DLL call takes a round trip time to the controller, and every
+  serial command and reply its transmission time at 115200 baud;
+- motion programs (see Program) run on a thread of their own, as they
+  would on the controller, and digital output 0 of the controller is
+  wired to the timing input of the sensor, which then latches a reading.
+
+Queued motion programs are only simulated so far: queue() measures a Scan
+with them here, but drivers/a3200.py and acquisition/scan.py do not offer
+them until the controller and sensor commands they use have been checked
+on the hardware.
+
+Properties:
+stage -- The simulated gantry.
+surface -- The simulated part under the sensor.
+sensor -- The simulated sensor, used as its port by drivers/keyence.py.
+dll -- The simulated A32SYS and A32CMPLR libraries.
+
+Classes:
+AxisModel -- Position of one axis over time.
+Stage -- The axes of the gantry, updated by the simulated DLL.
+DLL -- The Aer* functions used by drivers/a3200.py, acting on a Stage.
+Surface -- Synthetic surface with noise, drift and dark regions.
+SensorPort -- Serial port answering like a Keyence looking at a Surface.
+Program -- A sequence of XY points queued and run by the controller.
+
+Functions:
+enabled -- Whether the drivers should use the simulator.
+program_text -- The AeroBasic source of a Program.
+latched -- Read the readings latched by the sensor's timing input.
+queue -- Measure a Scan with queued motion programs.
+benchmark -- Measure the throughput of Scan.run in points per second.
+"""
+
+import ctypes
+import math
+import os
+import sys
+import threading
+import time
+import numpy
+from lsst.drivers import fakeport
+
+def enabled():
+    return bool(os.environ.get('LSST_SIMULATE'))
+
+class AxisModel:
+    def __init__(self, acceleration=1e6, settle=.02):
+        """Create an axis at rest at 0.
+
+        Units are those of the DLL: machine steps (1 um on the X and Y
+        axes), and seconds.  Parameter 'settle' is the time to settle
+        after each move.
+        """
+        self.acceleration, self.settle = float(acceleration), settle
+        self.p0 = self.p1 = 0.
+        self.t0 = self.t1 = self.done = 0.
+        self.ta = self.tc = self.vp = 0.
+        self.freerun = 0.
+
+    def position(self, now):
+        if self.freerun: return self.p0 + self.freerun * (now - self.t0)
+        t = min(max(now - self.t0, 0), self.t1 - self.t0)
+        a, sign = self.acceleration, (1 if self.p1 >= self.p0 else -1)
+        if t < self.ta: s = a*t*t/2
+        elif t < self.ta + self.tc: s = a*self.ta**2/2 + self.vp*(t-self.ta)
+        else: s = abs(self.p1 - self.p0) - a*(self.t1 - self.t0 - t)**2/2
+        return self.p0 + sign*s
+
+    def move(self, target, velocity, now):
+        """Start a move to 'target' at up to 'velocity' steps per second."""
+        self.p0, self.t0 = self.position(now), now
+        self.p1, self.freerun = float(target), 0.
+        d, a = abs(self.p1 - self.p0), self.acceleration
+        self.ta = min(abs(velocity) / a, math.sqrt(d / a))
+        self.vp = a * self.ta
+        self.tc = (d - a*self.ta**2) / self.vp if self.vp else 0.
+        self.t1 = now + 2*self.ta + self.tc
+        self.done = self.t1 + (self.settle if d else 0)
+
+    def run(self, velocity, now):
+        """Start moving at 'velocity' until halted."""
+        self.p0, self.t0, self.freerun = self.position(now), now, velocity
+        self.done = float('inf')
+
+    def halt(self, now):
+        self.p0 = self.p1 = self.position(now)
+        self.t0 = self.t1 = now
+        self.freerun, self.done = 0., now + self.settle
+
+class Stage:
+    def __init__(self, axes=3, **kwargs):
+        """Create a gantry of AxisModel(**kwargs) axes."""
+        self.axes = [AxisModel(**kwargs) for i in range(axes)]
+        self.lock = threading.Lock()
+
+    def masked(self, mask):
+        return [axis for i, axis in enumerate(self.axes) if mask & 2**i]
+
+    def wait(self, axes):
+        """Sleep until all of 'axes' are done (or running freely)."""
+        with self.lock:
+            done = max([axis.done for axis in axes if axis.freerun == 0] +
+                       [0])
+        time.sleep(max(done - time.time(), 0))
+
+    def xy(self, now=None):
+        """Return the current (x, y) position in mm."""
+        now = time.time() if now is None else now
+        with self.lock:
+            return (self.axes[0].position(now) / 1000.,
+                    self.axes[1].position(now) / 1000.)
+
+class DLL:
+    """The functions of A32SYS and A32CMPLR that drivers/a3200.py uses.
+
+    Every function takes the same arguments as the Aerotech one, writes
+    its results through the ctypes pointers it is given and returns 0,
+    after the round trip time to the controller.
+    """
+
+    def __init__(self, stage, steps=1000., latency=.002, outputs=None):
+        """Act on 'stage', whose X and Y axes have 'steps' steps per mm.
+
+        Every command and status call takes 'latency' seconds.  Parameter
+        'outputs' maps the number of a digital output to the function
+        called when a program sets it to 1.
+        """
+        self.stage, self.steps, self.latency = stage, steps, latency
+        self.outputs = outputs or {}
+        self.globals, self.tasks = {}, {}
+        self.elapsed = 0. #Total time spent moving and dwelling in programs
+
+    def move(self, index, func, *params):
+        time.sleep(self.latency)
+        return self.command(index, func, *params)
+
+    def command(self, index, func, *params):
+        with self.stage.lock:
+            func(self.stage.axes[index], *(params + (time.time(),)))
+        return 0
+
+    #System
+    def AerSysIsSystemInitialized(self, result):
+        result.contents.value = 0
+        return 0
+    def AerSysInitialize(self, *params): return 0
+    def AerSysOpen(self, *params): return 0
+    def AerSysClose(self, handle): return 0
+    def AerSysFaultAck(self, handle, mask, *params): return 0
+    def AerErrGetMessageEx(self, errornum, buf, size, *params):
+        buf.value = ('Simulated error ' + str(errornum)).encode('ascii')
+        return 0
+
+    #Motion
+    def AerMoveEnable(self, handle, index): return 0
+    def AerMoveDisable(self, handle, index): return 0
+    def AerMoveAbsolute(self, handle, index, dest, vel):
+        return self.move(index, AxisModel.move, dest, vel)
+    def AerMoveIncremental(self, handle, index, disp, vel):
+        return self.move(index, lambda axis, now: axis.move(
+            axis.position(now) + disp, vel, now))
+    def AerMoveHome(self, handle, index):
+        return self.move(index, AxisModel.move, 0, 1e5)
+    def AerMoveFreerun(self, handle, index, direction, vel):
+        return self.move(index, AxisModel.run, direction * vel)
+    def AerMoveHalt(self, handle, index):
+        return self.move(index, AxisModel.halt)
+    def AerMoveWaitDone(self, handle, index, timeout, zero):
+        self.stage.wait([self.stage.axes[index]])
+        time.sleep(self.latency)
+        return 0
+    def AerMoveMWaitDone(self, handle, mask, timeout, zero):
+        self.stage.wait(self.stage.masked(mask))
+        time.sleep(self.latency)
+        return 0
+
+    #Programs
+    def AerTaskProgramRunText(self, handle, task, text):
+        self.AerTaskProgramAbort(handle, task)
+        time.sleep(self.latency)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.program,
+                                  args=(text.decode('ascii'), stop))
+        thread.daemon = True
+        self.tasks[task] = (thread, stop)
+        thread.start()
+        return 0
+    def AerTaskProgramAbort(self, handle, task):
+        if task in self.tasks:
+            self.tasks[task][1].set()
+            self.tasks.pop(task)[0].join()
+        return 0
+    def AerVarGlobalGetDouble(self, handle, index, result):
+        time.sleep(self.latency)
+        result[0] = self.globals.get(index, 0.)
+        return 0
+    def AerVarGlobalSetDouble(self, handle, index, value):
+        time.sleep(self.latency)
+        self.globals[index] = value.value
+        return 0
+
+    def program(self, text, stop):
+        """Run the lines of a program made by program_text."""
+        for line in text.splitlines():
+            if stop.is_set(): break
+            start = time.time()
+            words = line.split()
+            if words[0] == 'LINEAR':
+                args = dict((word[0], float(word[1:])) for word in words[1:])
+                for index, name in enumerate('XY'):
+                    self.command(index, AxisModel.move,
+                                 args[name]*self.steps, args['F']*self.steps)
+                self.stage.wait(self.stage.axes[:2])
+            elif words[0] == 'DWELL': time.sleep(float(words[1]))
+            elif line.startswith('$DO['):
+                output, value = line[len('$DO['):].split('].X=')
+                if value == '1' and int(output) in self.outputs:
+                    self.outputs[int(output)]()
+            elif line.startswith('DGLOBAL('):
+                index, value = line[len('DGLOBAL('):].split(')=')
+                self.globals[int(index)] = (
+                    self.stage.xy()['XY'.index(value[5])]
+                    if value.startswith('PFBK(') else float(value))
+            elif line.startswith('WAIT(DGLOBAL('):
+                index, value = line[len('WAIT(DGLOBAL('):-1].split(')>=')
+                while (self.globals.get(int(index), 0.) < float(value) and
+                       not stop.is_set()):
+                    time.sleep(.0001)
+                continue #Waiting for the host is not time spent moving
+            self.elapsed += time.time() - start
+
+    #Status
+    def AerStatusGetAxisInfoPosition(self, handle, mask, zero, result,
+                                     *unused):
+        #One position per axis in the mask, in axis order, taken when the
+        #request reaches the controller halfway through the round trip
+        time.sleep(self.latency / 2)
+        with self.stage.lock:
+            now = time.time()
+            for n, axis in enumerate(self.stage.masked(mask)):
+                result[n] = axis.position(now)
+        time.sleep(self.latency / 2)
+        return 0
+
+class Surface:
+    def __init__(self, noise=.5, drift=.05, seed=0):
+        """Create a random surface, in um over coordinates in mm.
+
+        The surface is a tilted bowl with ripples and holes.  Parameter
+        'noise' is the standard deviation of one unaveraged sample, and
+        'drift' the rate in um/s at which the whole surface rises.
+        """
+        random = numpy.random.RandomState(seed)
+        self.tilt = random.normal(0, .05, 2)
+        self.bowl = random.normal(0, 1e-4)
+        self.ripple = random.uniform(5, 20, 2)
+        self.holes = [(random.uniform(-50, 50, 2), random.uniform(1, 3))
+                      for i in range(3)]
+        self.noise, self.drift, self.random = noise, drift, random
+        self.start = time.time()
+
+    def height(self, xy, t, samples=0):
+        """Return the reading at 'xy' at time 't', or None if dark.
+
+        Parameter 'samples' is the base-2 log of the number of samples
+        averaged, as in keyence.set_samples.
+        """
+        xy = numpy.asarray(xy, dtype='float')
+        for center, radius in self.holes:
+            if numpy.sum((xy - center)**2) < radius**2: return None
+        return (self.tilt.dot(xy) + self.bowl * xy.dot(xy) +
+                numpy.sin(xy / self.ripple).sum() +
+                self.drift * (t - self.start) +
+                self.random.normal(0, self.noise / 2**(samples/2.)))
+
+class SensorPort(fakeport.FakePort):
+    def __init__(self, stage, surface, baud=115200):
+        """Create a Keyence on a serial port, looking at 'surface'."""
+        fakeport.FakePort.__init__(self, self.reply)
+        self.stage, self.surface, self.baud = stage, surface, baud
+        self.samples, self.mode = {1: 4, 2: 4}, 1
+        self.latched = []
+
+    def write(self, data):
+        #Hold the caller for the time to send the command and its reply
+        count = len(self.replies)
+        fakeport.FakePort.write(self, data)
+        size = len(data) + sum(map(len, self.replies[count:]))
+        time.sleep(10. * size / self.baud)
+
+    def reading(self, out):
+        z = self.surface.height(self.stage.xy(), time.time(),
+                                self.samples[out])
+        return '+99999.9999' if z is None else '{0:+010.4f}'.format(z)
+
+    def trigger(self):
+        """Latch a reading of output 1, as a pulse on the timing input."""
+        self.latched.append(self.reading(1))
+
+    def reply(self, command):
+        if command[0] in ['M1', 'M2']:
+            return command[0] + ',' + self.reading(int(command[0][1]))
+        elif command[0] == 'M0':
+            return 'M0,' + self.reading(1) + ',' + self.reading(2)
+        elif command[:2] == ['SR', 'OA'] and command[2] in ['1', '2']:
+            return 'SR,OA,{0},{1:X}'.format(command[2],
+                                            self.samples[int(command[2])])
+        elif command[:2] == ['SD', 'OA']:
+            for out in ([1, 2] if command[2] == '0' else [int(command[2])]):
+                self.samples[out] = int(command[3], 16)
+            return 'SD,OA'
+        elif command[:2] == ['SR', 'SC']:
+            return 'SR,SC,{0:X}'.format(self.mode)
+        elif command[:2] == ['SD', 'SC']:
+            self.mode = int(command[2], 16)
+            return 'SD,SC'
+        elif command == ['TR']:
+            #Not a command of the real sensor: see latched()
+            readings, self.latched = self.latched, []
+            return ','.join(['TR'] + readings)
+        else: return 'ER,' + command[0] + ',00'
+
+def program_text(points, velocity, dwell=0., readback=False, window=50):
+    """Return an AeroBasic program visiting a list of (x, y) points.
+
+    At every point the program waits 'dwell' seconds, pulses digital
+    output 0 to trigger the sensor and counts the point in DGLOBAL(0).
+    With 'readback', the position at point n is first copied to DGLOBAL(k)
+    and DGLOBAL(k+1), k = 2 + 2*(n % window).  The program only stops for
+    the host when it is 'window' points ahead of the count the host has
+    acknowledged in DGLOBAL(1).  Distances are in mm and times in seconds.
+    """
+    lines = ['DGLOBAL(0)=0', 'DGLOBAL(1)=0']
+    for n, pt in enumerate(points):
+        if n >= window:
+            lines.append('WAIT(DGLOBAL(1)>={0})'.format(n + 1 - window))
+        lines.append('LINEAR X{0:.4f} Y{1:.4f} F{2:.4f}'
+                     .format(pt[0], pt[1], velocity))
+        if dwell: lines.append('DWELL {0:.4f}'.format(dwell))
+        lines.extend(['$DO[0].X=1', '$DO[0].X=0'])
+        if readback:
+            k = 2 + 2*(n % window)
+            lines.append('DGLOBAL({0})=PFBK(X)'.format(k))
+            lines.append('DGLOBAL({0})=PFBK(Y)'.format(k + 1))
+        lines.append('DGLOBAL(0)={0}'.format(n + 1))
+    return '\n'.join(lines) + '\n'
+
+def latched():
+    """Return the readings latched by the sensor since the last call.
+
+    Readings are in um, or None where no surface was visible.  The 'TR'
+    command that returns them only exists on the simulated sensor: how
+    the LT-9501 stores and returns triggered readings is yet to be
+    checked.
+    """
+    from lsst.drivers import keyence
+    values = [float(v) for v in keyence.raw_command(['TR'])[1:]]
+    return [None if abs(v) > 5000 else v for v in values]
+
+class Program:
+    """A sequence of XY points run by the controller from its own queue.
+
+    The whole sequence is sent in one DLL call.  The controller triggers
+    the sensor at every point itself, so the stage never waits for the
+    host to read it: the host polls the number of points reached and
+    collects the latched readings behind the stage, up to 'window' points
+    behind.
+
+    Programs only run on the simulated controller: the DLL functions they
+    use (TaskProgramRunText, VarGlobalGetDouble, VarGlobalSetDouble and
+    TaskProgramAbort), the AeroBasic of program_text and the trigger
+    wiring have yet to be checked on the hardware, so drivers/a3200.py
+    does not offer them.
+
+    Instance variables:
+    points -- The (x, y) points of the program, in mm.
+    text -- The AeroBasic source of the program.
+    task -- The controller task the program runs on.
+
+    Methods:
+    start -- Send the program to the controller and start it.
+    get -- Return the value of a global variable of the controller.
+    reached -- Return the number of points reached so far.
+    acknowledge -- Let the program run up to 'window' points further.
+    position -- Read the stage position at a point not yet acknowledged.
+    abort -- Stop the program.
+    run -- Run the program, calling a hook for every point.
+    """
+
+    def __init__(self, points, velocity=100, dwell=0., readback=False,
+                 window=50, task=1):
+        """Create a program.
+
+        Parameters:
+        points -- A list of (x, y) points in mm.
+        velocity -- The speed of every move in mm/sec.
+        dwell -- Seconds to wait at every point before triggering.
+        readback -- Whether to read the stage position at every point.
+        window -- The most points the program runs ahead of the host.
+        task -- The controller task to run the program on.
+        """
+        assert enabled(), 'motion programs only run on the simulator so far'
+        self.points, self.task = list(points), task
+        self.readback, self.window = readback, window
+        self.text = program_text(self.points, velocity, dwell, readback,
+                                 window)
+        self.buffer = (ctypes.c_double * 1)()
+
+    def start(self):
+        from lsst.drivers import a3200
+        a3200.dllfunc("TaskProgramRunText", self.task,
+                      self.text.encode('ascii'))
+
+    def get(self, index):
+        from lsst.drivers import a3200
+        a3200.dllfunc("VarGlobalGetDouble", index, self.buffer)
+        return self.buffer[0]
+
+    def reached(self): return int(self.get(0))
+
+    def acknowledge(self, count):
+        from lsst.drivers import a3200
+        a3200.dllfunc("VarGlobalSetDouble", 1, ctypes.c_double(count))
+
+    def position(self, n):
+        """Return the stage position at point n.
+
+        It is only valid until point n is acknowledged, after which the
+        program may reuse its globals.
+        """
+        k = 2 + 2*(n % self.window)
+        return (self.get(k), self.get(k + 1))
+
+    def abort(self):
+        from lsst.drivers import a3200
+        a3200.dllfunc("TaskProgramAbort", self.task)
+
+    def run(self, hook=None, poll=.0005):
+        """Run the program and return once every point has been handled.
+
+        Parameters:
+        hook -- Function called as hook(n, t, z, position), in order, for
+            every point n: 't' is the time the host saw the point reached,
+            'z' the reading latched there (um, or None if dark) and
+            'position' the stage position read back, or None.  The stage
+            only waits for it if the host falls 'window' points behind.
+        poll -- Seconds between two polls of the controller while no new
+            point has been reached.
+
+        The program is aborted if the hook raises.
+        """
+        self.start()
+        readings, done = [], 0
+        try:
+            while done < len(self.points):
+                reached = self.reached()
+                if reached == done:
+                    time.sleep(poll)
+                    continue
+                t = time.time()
+                while len(readings) < reached - done:
+                    readings.extend(latched())
+                for n in range(done, reached):
+                    position = self.position(n) if self.readback else None
+                    if hook: hook(n, t, readings.pop(0), position)
+                done = reached
+                self.acknowledge(done)
+        except:
+            self.abort()
+            raise
+
+def queue(scan, segment=1000, window=50):
+    """Measure a scan.Scan with motion programs queued on the controller.
+
+    Up to 'segment' points at a time are sent as one Program, which dwells
+    for the integration time at every point and then triggers the sensor.
+    Each reading is stored (with the gantry correction, the scan log and
+    scan.flatness) once the host has collected it, while the program runs
+    up to 'window' points ahead.  Drift cycles are run between programs:
+    the schedule is asked when a point is queued rather than when it is
+    reached.
+    """
+    from lsst.drivers import keyence
+    pending = []
+    def hook(n, t, z, position):
+        if scan.readback: scan.actual = position
+        pending[n][1](t, z)
+    def flush():
+        if pending:
+            Program([pt for pt, store in pending], scan.velocity,
+                    keyence.get_time(), scan.readback, window).run(hook)
+            del pending[:]
+    scan.open_log()
+    try:
+        sys.stdout.write('00%')
+        for job in scan.jobs(flush):
+            pending.append(job)
+            if len(pending) == segment: flush()
+        flush()
+    finally: scan.close_log()
+    if scan.telemetry: scan.data.join(scan.telemetry)
+    sys.stdout.write('\b\b\b100%')
+
+stage = Stage()
+surface = Surface()
+sensor = SensorPort(stage, surface)
+dll = DLL(stage, outputs={0: sensor.trigger})
+
+def benchmark(side=10, step=1., samples=0, mode=(4, 1), velocity=600,
+              modes=('run', 'pipeline', 'queue')):
+    """Scan a side x side grid with the simulated drivers.
+
+    Each of 'modes' is a way to run the scan: Scan.run, Scan.run with a
+    pipeline.Pipeline, or queue().  The sensor is set to 2**samples
+    samples per reading in scan 'mode' (see keyence.py).  Prints and
+    returns a dictionary of the points per second of each mode and, if
+    'queue' is one of them, of the host overhead per point of each mode:
+    its time per point beyond the moves, integration dwells and triggers
+    of the controller (for 'queue', the time the program spends waiting
+    for the host, and starting and finishing).
+    """
+    assert enabled(), 'set LSST_SIMULATE before importing the drivers'
+    from lsst.acquisition import data, drift_correct, pipeline, scan
+    from lsst.drivers import a3200, keyence
+    keyence.open()
+    keyence.set_samples(samples)
+    keyence.set_scan_mode(mode)
+    rates, seconds = {}, {}
+    for name in modes:
+        axis = numpy.arange(side) * step
+        d = data.raster_data(axis, axis)
+        s = scan.Scan(d, drift_correct.DriftCorrector(), None)
+        s.velocity = velocity
+        a3200.xymove((0, 0))
+        start, dll.elapsed = time.time(), 0.
+        if name == 'queue': queue(s)
+        else: s.run(pipeline.Pipeline(velocity=velocity)
+                    if name == 'pipeline' else None)
+        seconds[name] = (time.time() - start) / len(d)
+        rates[name] = 1 / seconds[name]
+        if name == 'queue': busy = dll.elapsed / len(d)
+    result = {'points/s': rates}
+    if 'queue' in modes:
+        result['overhead'] = dict((name, seconds[name] - busy)
+                                  for name in seconds)
+    print('')
+    for name in modes:
+        print('{0:>9}: {1:6.1f} points/s'.format(name, rates[name]) +
+              ('' if 'queue' not in modes else
+               ', {0:6.2f} ms/point host overhead'
+               .format(1000 * result['overhead'][name])))
+    return result
+
+if __name__ == '__main__':
+    os.environ.setdefault('LSST_SIMULATE', '1')
+    benchmark()
@@ -0,0 +1,118 @@
+"""Background sampling of environmental telemetry.
+
+Reading the NetBotz or the TempPoint starts a new process every time,
+which is far too slow to do next to every measured point.  A Telemetry
+object instead polls all of its channels on a background thread at a
+fixed rate and keeps the readings in a ring buffer, so the value of any
+channel at any recent time is an interpolation away.
+
+Classes:
+Telemetry -- Thread polling a set of channels into a ring buffer.
+
+Functions:
+lab_channels -- The NetBotz and TempPoint channels of the lab.
+fake_channels -- Synthetic channels standing in for the real devices.
+"""
+
+import threading
+import time
+import numpy
+
+def lab_channels(rtds=(0,)):
+    """Return a dictionary of channel names to reading functions."""
+    from lsst.drivers import netbotz, temppoint
+    channels = {'temperature': netbotz.temperature,
+                'humidity': netbotz.humidity,
+                'dewpoint': netbotz.dewpoint}
+    for chan in rtds:
+        channels['rtd' + str(chan)] = (lambda chan=chan: temppoint.get(chan))
+    return channels
+
+def fake_channels(start=None, rate=.001, noise=.01, seed=0):
+    """Return channels like lab_channels() that need no hardware.
+    
+    The temperature rises by 'rate' degrees per second from 20 degrees at
+    time 'start' (default: now), the humidity is steady and every reading
+    has gaussian noise of standard deviation 'noise'.
+    """
+    start = time.time() if start is None else start
+    random = numpy.random.RandomState(seed)
+    temp = lambda: 20 + rate*(time.time() - start)
+    return {'temperature': lambda: temp() + random.normal(0, noise),
+            'humidity': lambda: 40 + random.normal(0, noise),
+            'dewpoint': lambda: temp() - 14 + random.normal(0, noise),
+            'rtd0': lambda: temp() + .5 + random.normal(0, noise)}
+
+class Telemetry(threading.Thread):
+    def __init__(self, channels, period=1., size=86400):
+        """Poll 'channels' every 'period' seconds, keeping 'size' readings.
+        
+        Parameter 'channels' is a dictionary of names to functions that
+        return a number, or None if there is no reading.  A channel that
+        fails or returns None is recorded as nan.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.names = sorted(channels)
+        self.channels = [channels[name] for name in self.names]
+        self.period, self.size, self.count = period, size, 0
+        self.times = numpy.empty(size)
+        self.values = numpy.empty((size, len(self.names)))
+        self.lock, self.stopped = threading.Lock(), threading.Event()
+    
+    def poll(self):
+        """Read every channel once and store the readings."""
+        row = numpy.empty(len(self.channels))
+        t0 = time.time()
+        for n, channel in enumerate(self.channels):
+            try: value = channel()
+            except Exception: value = None
+            row[n] = numpy.nan if value is None else value
+        with self.lock:
+            self.times[self.count % self.size] = (t0 + time.time()) / 2
+            self.values[self.count % self.size] = row
+            self.count += 1
+    
+    def run(self):
+        while not self.stopped.is_set():
+            start = time.time()
+            self.poll()
+            self.stopped.wait(max(0, self.period - (time.time() - start)))
+    
+    def stop(self):
+        self.stopped.set()
+        self.join()
+    
+    def series(self, name=None):
+        """Return (times, values) of the buffered readings, oldest first.
+        
+        The values are of one channel if 'name' is given, else of all
+        channels, one column each, in the order of self.names.
+        """
+        with self.lock:
+            n = min(self.count, self.size)
+            order = (numpy.arange(n) + self.count - n) % self.size
+            times, values = self.times[order], self.values[order]
+        return times, (values if name is None else
+                       values[:,self.names.index(name)])
+    
+    def at(self, t, name=None):
+        """Return the readings interpolated at time(s) 't'.
+        
+        With 'name', the result has the shape of 't'; without it, a final
+        dimension with one entry per channel is added.  Times outside the
+        buffer get the oldest or newest reading, and nan if there is none.
+        """
+        times, values = self.series()
+        t = numpy.asarray(t, dtype='float')
+        result = numpy.empty(t.shape + (len(self.names),))
+        for n in range(len(self.names)):
+            good = numpy.isfinite(values[:,n])
+            result[...,n] = (numpy.interp(t, times[good], values[good,n])
+                             if good.any() else numpy.nan)
+        return result if name is None else \
+            result[...,self.names.index(name)]
+    
+    def latest(self, name):
+        """Return the most recent reading of one channel."""
+        return self.series(name)[1][-1] if self.count else numpy.nan
@@ -10,6 +10,5 @@ path = r"C:\tp_get_rtd.exe"
 
 def get(chan = 0):
     query = subprocess.Popen(path+' '+str(chan+1), stdout=subprocess.PIPE)
-    query.wait()
     result = float(query.communicate()[0])
     return result if result < 80000 else None
@@ -46,23 +46,35 @@ def home():
     a3200.xyhome()
 
 @print_code
-def setup_raster(xmin, xmax, xstep, ymin, ymax, ystep):
+def setup_raster(xmin, xmax, xstep, ymin, ymax, ystep, log=None):
     global data, scan, mydata, myscan
     from lsst.acquisition import data, scan
     mydata = data.raster_data(arange(xmin, xmax, xstep),
                               arange(ymin, ymax, ystep))
-    myscan = scan.Scan(mydata)
+    myscan = scan.Scan(mydata, log=log)
 
 @print_code
-def setup_tiled(tile_orig, points):
+def setup_tiled(tile_orig, points, log=None):
     global data, scan, mydata, myscan
     from lsst.acquisition import data, scan
     mydata = data.tiled_data(tile_orig, points)
-    myscan = scan.Scan(mydata)
+    myscan = scan.Scan(mydata, log=log)
+
+@print_code
+def setup_adaptive(xmin, xmax, xstep, ymin, ymax, ystep, residual=1.,
+                   depth=3):
+    global data, adaptive, mydata, myscan
+    from lsst.acquisition import data, adaptive
+    myscan = adaptive.AdaptiveScan(arange(xmin, xmax, xstep),
+                                   arange(ymin, ymax, ystep), residual,
+                                   depth=depth)
+    mydata = myscan.data
 
 @print_code
 def run_scan():
+    global mydata
     myscan.run()
+    mydata = myscan.data
 
 @print_code
 def close():
@@ -78,7 +90,8 @@ def process_data():
 
 @print_code
 def save_results(path):
-    myscan.write(open(path, 'w'))
+    if path.endswith('.scan'): myscan.save(path)
+    else: myscan.write(open(path, 'w'))
 
 def script():
     print('\nWelcome to interactive object scanner')
@@ -115,12 +128,20 @@ def script():
         print('Please enter these parameters for points relative to tiles:')
         points = to_points(read())
         setup_tiled(tiles, points)
+    elif raw_input('Is this to be an adaptive scan? (y/N) ').lower() == 'y':
+        print('Please enter these parameters for the coarse points:')
+        values = read()
+        residual = float(raw_input('Largest residual from flat (um): '))
+        print('\nSetting up scan...')
+        setup_adaptive(*values, residual=residual)
+        print('Ready to scan.\n')
     else:
         print('Please enter these parameters to describe point locations:')
         values = read()
         print('\nSetting up scan...')
         setup_raster(*values)
         print('Ready to scan.\n')
+    print(mydata.plan())
     raw_input('Press enter to scan.')
     print('Scanning... ')
     run_scan()